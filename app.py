@@ -6,13 +6,28 @@ This is the main Flask application for the YouTube to WAV Converter.
 """
 import os
 import re
+import json
+import math
 import time
+import zlib
+import hashlib
+import struct
 import logging
+import uuid
+import shutil
+import sqlite3
+import tempfile
+import threading
+import subprocess
+import mmap
 from datetime import datetime
+from collections import deque, Counter, OrderedDict
+from urllib.parse import urlparse, quote
 
-from flask import Flask, request, jsonify, send_from_directory, render_template
+from flask import Flask, request, jsonify, send_from_directory, render_template, redirect, Response
+from werkzeug.datastructures import ContentRange
+from werkzeug.security import safe_join
 import yt_dlp
-from pydub import AudioSegment
 
 # Initialize logger
 logger = logging.getLogger(__name__)
@@ -22,10 +37,73 @@ app = Flask(__name__,
             static_folder='static',
             template_folder='templates')
 
+def default_memory_budget():
+    """Half of physical memory, or 2GB where that cannot be determined."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+    except (AttributeError, ValueError, OSError):
+        return 2 * 1024 ** 3
+
 # Configuration
-TEMP_AUDIO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'temp_audio')
+TEMP_AUDIO_DIR = os.environ.get('TEMP_AUDIO_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'temp_audio')
 app.config['TEMP_AUDIO_FOLDER'] = TEMP_AUDIO_DIR
 app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB max file size
+# Keep a copy of streamed conversions in TEMP_AUDIO_DIR for later requests
+app.config['STREAM_CACHE'] = os.environ.get('STREAM_CACHE', '1') == '1'
+# Conversion pipeline: resolve workers feed network-bound download workers,
+# which feed CPU-bound transcode workers through a bounded queue
+app.config['RESOLVE_WORKERS'] = int(os.environ.get('RESOLVE_WORKERS', 4))
+app.config['DOWNLOAD_WORKERS'] = int(os.environ.get('DOWNLOAD_WORKERS', 8))
+app.config['TRANSCODE_WORKERS'] = int(os.environ.get('TRANSCODE_WORKERS', os.cpu_count() or 2))
+app.config['TRANSCODE_QUEUE_SIZE'] = int(os.environ.get('TRANSCODE_QUEUE_SIZE', app.config['TRANSCODE_WORKERS']))
+# Download scheduling: shortest job (by duration) first; queued jobs gain
+# SJF_AGING_RATE seconds of priority per second waited, and FAST_LANE_WORKERS
+# download workers only take jobs up to SHORT_JOB_SECONDS long
+app.config['FAST_LANE_WORKERS'] = int(os.environ.get('FAST_LANE_WORKERS', 1))
+app.config['SHORT_JOB_SECONDS'] = int(os.environ.get('SHORT_JOB_SECONDS', 600))
+app.config['SJF_AGING_RATE'] = float(os.environ.get('SJF_AGING_RATE', 10))
+# Concurrent downloads against one site (0 = unlimited); the fast-lane
+# workers are not counted against it
+app.config['MAX_DOWNLOADS_PER_HOST'] = int(os.environ.get('MAX_DOWNLOADS_PER_HOST', 6))
+# Transcodes are admitted while the sum of their estimated peak memory
+# (JOB_MEMORY_BASE + JOB_MEMORY_FACTOR x decoded PCM size) fits MEMORY_BUDGET
+app.config['MEMORY_BUDGET'] = int(os.environ.get('MEMORY_BUDGET', default_memory_budget()))
+app.config['JOB_MEMORY_BASE'] = int(os.environ.get('JOB_MEMORY_BASE', 64 * 1024 ** 2))
+app.config['JOB_MEMORY_FACTOR'] = float(os.environ.get('JOB_MEMORY_FACTOR', 0.02))
+# Admission control: unfinished jobs and jobs waiting for a resolve or download worker
+# (0 = unlimited); beyond either limit /download answers 429 + Retry-After
+app.config['MAX_ACTIVE_JOBS'] = int(os.environ.get('MAX_ACTIVE_JOBS', 64))
+app.config['MAX_QUEUE_DEPTH'] = int(os.environ.get('MAX_QUEUE_DEPTH', 32))
+app.config['RETRY_AFTER_DEFAULT'] = int(os.environ.get('RETRY_AFTER_DEFAULT', 30))
+# URLs per batch or playlist, and never more than MAX_ACTIVE_JOBS or MAX_QUEUE_DEPTH
+app.config['MAX_BATCH_SIZE'] = int(os.environ.get('MAX_BATCH_SIZE', 100))
+# How long finished jobs stay queryable
+app.config['JOB_RETENTION'] = int(os.environ.get('JOB_RETENTION', 3600))
+# Cache janitor: byte budget and max idle age for finished files (0 = unlimited)
+app.config['CACHE_MAX_BYTES'] = int(os.environ.get('CACHE_MAX_BYTES', 20 * 1024 ** 3))
+app.config['CACHE_MAX_AGE'] = int(os.environ.get('CACHE_MAX_AGE', 7 * 24 * 3600))
+app.config['JANITOR_INTERVAL'] = int(os.environ.get('JANITOR_INTERVAL', 60))
+# Re-read each cached file against its write-time digests at most this often (0 disables)
+app.config['CACHE_VERIFY_INTERVAL'] = int(os.environ.get('CACHE_VERIFY_INTERVAL', 24 * 3600))
+# Store outputs as 'flac' masters (about half the disk) and rebuild the WAV on download, or as 'wav'
+app.config['CACHE_FORMAT'] = os.environ.get('CACHE_FORMAT', 'flac').lower()
+# Spacing of FLAC seek points used to answer Range requests without decoding from the start
+app.config['SEEK_INDEX_INTERVAL'] = int(os.environ.get('SEEK_INDEX_INTERVAL', 10))
+# Cache-Control max-age for finished outputs served with a content-digest ETag
+app.config['DOWNLOAD_MAX_AGE'] = int(os.environ.get('DOWNLOAD_MAX_AGE', 365 * 24 * 3600))
+# Hand finished files to the front-end server instead of streaming them from Python:
+# 'x-accel' (nginx X-Accel-Redirect under SENDFILE_PREFIX) or 'x-sendfile' (Apache, lighttpd)
+app.config['SENDFILE_MODE'] = os.environ.get('SENDFILE_MODE', '').lower()
+app.config['SENDFILE_PREFIX'] = os.environ.get('SENDFILE_PREFIX', '/protected-audio/')
+# Video metadata cache, which maps URLs extract_video_id() does not recognise
+# to their video id; set METADATA_DB to a file path to persist it in SQLite
+app.config['METADATA_CACHE_SIZE'] = int(os.environ.get('METADATA_CACHE_SIZE', 1024))
+app.config['METADATA_TTL'] = int(os.environ.get('METADATA_TTL', 6 * 3600))
+app.config['METADATA_DB'] = os.environ.get('METADATA_DB') or None
+
+# Per-job scratch directories, grouped by process id; nothing in here
+# outlives the process that created it
+SCRATCH_DIR = os.path.join(TEMP_AUDIO_DIR, '.scratch')
 
 # Ensure temp directory exists
 os.makedirs(TEMP_AUDIO_DIR, exist_ok=True)
@@ -33,19 +111,23 @@ os.makedirs(TEMP_AUDIO_DIR, exist_ok=True)
 # Import logging after app is created to avoid circular imports
 from logging.handlers import RotatingFileHandler
 
-# yt-dlp options for maximum audio quality
+# Output WAV parameters (48kHz, stereo, 16-bit PCM)
+SAMPLE_RATE = 48000
+CHANNELS = 2
+AUDIO_CODEC = 'pcm_s16le'
+SAMPLE_WIDTH = 2  # bytes per sample
+FFMPEG_BINARY = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+STREAM_CHUNK_SIZE = 64 * 1024
+PCM_CHUNK_SIZE = 256 * 1024  # whole frames: a multiple of CHANNELS * SAMPLE_WIDTH
+ZIP_CHUNK_SIZE = 1024 * 1024
+UNKNOWN_DURATION_COST = 3600  # scheduling cost for jobs without a known duration
+SSE_MIN_INTERVAL = 0.25  # seconds between progress events
+
+# yt-dlp options for maximum audio quality.
+# yt-dlp only fetches the best audio stream; transcode_to_wav() decodes it once
+# straight into the final WAV, so there is no postprocessor pass here.
 ydl_opts = {
     'format': 'bestaudio/best',
-    'postprocessors': [{
-        'key': 'FFmpegExtractAudio',
-        'preferredcodec': 'wav',
-        'preferredquality': '0',  # Highest quality
-    }],
-    'postprocessor_args': [
-        '-ar', '48000',           # Sample rate
-        '-ac', '2',               # Channels (stereo)
-        '-acodec', 'pcm_s16le'    # High quality PCM codec
-    ],
     'outtmpl': os.path.join(TEMP_AUDIO_DIR, 'youtube_audio_%(id)s.%(ext)s'),
     'quiet': False,
     'no_warnings': False,
@@ -64,6 +146,8 @@ ydl_opts = {
         'Sec-Fetch-Mode': 'navigate',
     },
     'keepvideo': False,
+    # A watch URL that also carries &list= is one video; playlists go through expand_collection()
+    'noplaylist': True,
 }
 
 def make_safe_filename(filename):
@@ -82,10 +166,45 @@ def serve_index():
     """Serve the main page."""
     return render_template('index.html')
 
+COLLECTION_URL_RE = re.compile(r'youtube\.com/(?:playlist\?|channel/|c/|user/|@)', re.IGNORECASE)
+
+def is_collection_url(url):
+    """True for playlist and channel URLs that should be expanded into one job per entry."""
+    return bool(COLLECTION_URL_RE.search(url))
+
+def expand_collection(url, limit):
+    """Expand a playlist or channel URL into (title, [entry URLs]) with one flat extraction.
+
+    Channel pages come back as a playlist of tabs (videos, shorts, ...); those
+    nested playlists are flattened too. At most limit entry URLs are returned.
+    """
+    with yt_dlp.YoutubeDL({'quiet': True, 'extract_flat': 'in_playlist'}) as ydl:
+        info = ydl.extract_info(url, download=False)
+
+    urls = []
+    def collect(playlist, depth):
+        for entry in playlist.get('entries') or []:
+            if len(urls) >= limit or not entry:
+                return
+            if entry.get('_type') == 'playlist' or entry.get('ie_key') == 'YoutubeTab':
+                if depth > 0 and entry.get('entries') is not None:
+                    collect(entry, depth - 1)
+                elif depth > 0 and entry.get('url'):
+                    with yt_dlp.YoutubeDL({'quiet': True, 'extract_flat': 'in_playlist'}) as ydl:
+                        collect(ydl.extract_info(entry['url'], download=False), depth - 1)
+                continue
+            entry_url = entry.get('url') or entry.get('webpage_url')
+            if not entry_url and entry.get('id'):
+                entry_url = f"https://www.youtube.com/watch?v={entry['id']}"
+            if entry_url:
+                urls.append(entry_url)
+    collect(info, depth=1)
+    return info.get('title') or 'playlist', urls
+
 def extract_video_id(url):
     """Extract video ID from various YouTube URL formats."""
     patterns = [
-        r'(?:youtube\.com/watch\?v=|youtu\.be/|youtube\.com/embed/|youtube\.com/v/|youtube\.com/watch/\?v=)([^&\n?#]*)',
+        r'(?:youtube\.com/watch\?v=|youtu\.be/|youtube\.com/embed/|youtube\.com/v/|youtube\.com/watch/\?v=|youtube\.com/shorts/|youtube\.com/live/)([^&\n?#/]*)',
         r'(?:youtube\.com/watch\?.*&v=([^&#]*))',
     ]
     
@@ -95,6 +214,1653 @@ def extract_video_id(url):
             return match.group(1)
     return None
 
+def cache_key(video_id, clip=None):
+    """Content address of an output: canonical video id plus encoding parameters.
+
+    clip is an optional (start, end) time range in seconds; end may be None.
+    """
+    key = f"{video_id}|{SAMPLE_RATE}|{CHANNELS}|{AUDIO_CODEC}"
+    return f"{key}|{format_clip(clip)}" if clip else key
+
+def format_clip(clip):
+    """'12.5-72' style label for a (start, end) clip; an open end is left blank."""
+    start, end = clip
+    return f"{start:g}-{'' if end is None else f'{end:g}'}"
+
+def parse_clip(data):
+    """(start, end) seconds from a request body with start/end keys, or None.
+
+    Raises ValueError for malformed or empty ranges.
+    """
+    if data.get('start') is None and data.get('end') is None:
+        return None
+    start = float(data.get('start') or 0)
+    end = None if data.get('end') is None else float(data['end'])
+    if not (0 <= start < math.inf) or (end is not None and not start < end < math.inf):
+        raise ValueError('start must be a non-negative time before end')
+    return start, end
+
+def clip_duration(clip, duration):
+    """Length in seconds of a clip of a video lasting duration seconds (None if unknown)."""
+    start, end = clip
+    if end is None or (duration and end > duration):
+        end = duration
+    return max(0, end - start) if end is not None else None
+
+def build_result(info, output_path, data_size=None):
+    """Build the payload returned to clients for a finished conversion.
+
+    Pass data_size (PCM bytes) when the WAV is not on disk as such.
+    """
+    duration = info.get('duration') or 0
+    size = os.path.getsize(output_path) if data_size is None else len(wav_header()) + data_size
+    return {
+        'filename': os.path.basename(output_path),
+        'title': info.get('title', 'audio'),
+        'uploader': info.get('uploader', 'unknown'),
+        'duration': duration,
+        'size_mb': round(size / (1024 * 1024), 2)
+    }
+
+def build_output_filename(info, clip=None):
+    """Build the final WAV filename from a yt-dlp info dict (and clip range, if any)."""
+    title = re.sub(r'[^\w\s-]', '', info.get('title', 'audio')).strip()
+    uploader = re.sub(r'[^\w\s-]', '', info.get('uploader', 'unknown')).strip()
+    video_id = info.get('id', str(int(time.time())))
+    if clip:
+        return f"{title} - {uploader} - {video_id} - {format_clip(clip)}.wav"
+    return f"{title} - {uploader} - {video_id}.wav"
+
+def wav_header(data_size=None):
+    """Build a canonical 44-byte PCM WAV header.
+
+    With data_size=None the sizes are unknown (streaming), so the RIFF and
+    data chunk sizes are set to the maximum value as ffmpeg does for pipes.
+    """
+    block_align = CHANNELS * SAMPLE_WIDTH
+    if data_size is None or data_size > 0xFFFFFFFF - 36:
+        riff_size = data_field = 0xFFFFFFFF
+    else:
+        riff_size = 36 + data_size
+        data_field = data_size
+    return struct.pack('<4sI4s4sIHHIIHH4sI',
+                       b'RIFF', riff_size, b'WAVE',
+                       b'fmt ', 16, 1, CHANNELS, SAMPLE_RATE,
+                       SAMPLE_RATE * block_align, block_align, SAMPLE_WIDTH * 8,
+                       b'data', data_field)
+
+def pcm_decode_command(source, http_headers=None, start=None, limit=None):
+    """ffmpeg command that decodes source to raw PCM on stdout.
+
+    start seeks the input before decoding; limit stops after that many
+    seconds of output. ffmpeg trims both to the exact sample.
+    """
+    cmd = [FFMPEG_BINARY, '-nostdin', '-hide_banner', '-loglevel', 'error']
+    if start:
+        cmd += ['-ss', str(start)]
+    if source.startswith(('http://', 'https://')):
+        cmd += ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5']
+        if http_headers:
+            cmd += ['-headers', ''.join(f"{k}: {v}\r\n" for k, v in http_headers.items())]
+    cmd += [
+        '-i', source,
+        '-vn', '-acodec', AUDIO_CODEC,
+        '-ar', str(SAMPLE_RATE),
+        '-ac', str(CHANNELS),
+    ]
+    if limit is not None:
+        cmd += ['-t', str(limit)]
+    cmd += ['-f', 's16le', 'pipe:1']
+    return cmd
+
+def iter_pcm(source, http_headers=None, duration=None, progress=None, chunk_size=PCM_CHUNK_SIZE,
+             start=None, limit=None):
+    """Decode source with ffmpeg and yield raw PCM in fixed-size chunks.
+
+    Only one chunk is held in memory at a time, so memory use does not grow
+    with the length of the input. If progress and duration (seconds) are
+    given, progress is called with transcode_percent as chunks arrive.
+    start and limit select a section, as in pcm_decode_command().
+    Raises RuntimeError if ffmpeg fails.
+    """
+    expected = duration * SAMPLE_RATE * CHANNELS * SAMPLE_WIDTH if duration else None
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(pcm_decode_command(source, http_headers, start, limit),
+                                stdout=subprocess.PIPE, stderr=stderr)
+        decoded = 0
+        try:
+            while True:
+                chunk = proc.stdout.read(chunk_size)
+                if not chunk:
+                    break
+                decoded += len(chunk)
+                if progress and expected:
+                    progress(transcode_percent=min(100.0, round(decoded * 100 / expected, 1)))
+                yield chunk
+
+            if proc.wait() != 0:
+                stderr.seek(0)
+                message = stderr.read().decode(errors='replace').strip()
+                raise RuntimeError(f"ffmpeg exited with {proc.returncode}: {message}")
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+
+class WavWriter:
+    """Write a PCM WAV file chunk by chunk.
+
+    A streaming header goes out first and is patched with the real sizes on
+    close(); the file only appears at path once it is complete. Used as a
+    context manager, the partial file is discarded if the block raises.
+    The bytes are hashed as they are written, so digests() is available
+    after close() without reading the file back.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data_size = 0
+        self.crc32 = None
+        self._data_crc = 0
+        self._data_sha256 = hashlib.sha256()
+        fd, self._partial_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+        self._open(fd)
+
+    def _open(self, fd):
+        self._file = os.fdopen(fd, 'wb')
+        self._file.write(wav_header())
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        self._data_crc = zlib.crc32(chunk, self._data_crc)
+        self._data_sha256.update(chunk)
+        self.data_size += len(chunk)
+
+    def close(self):
+        self._file.seek(0)
+        self._file.write(wav_header(self.data_size))
+        self._file.close()
+        self._finish()
+
+    def _finish(self):
+        os.replace(self._partial_path, self.path)
+        # CRC-32 of the complete WAV, without reading it back
+        self.crc32 = crc32_combine(zlib.crc32(wav_header(self.data_size)), self._data_crc, self.data_size)
+
+    def digests(self):
+        """CRC-32 of the whole file and SHA-256 of its PCM payload.
+
+        The header is only final after the data, so the SHA-256 covers the
+        samples alone; it identifies identical audio regardless of header.
+        """
+        return {'crc32': self.crc32, 'sha256': self._data_sha256.hexdigest()}
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._partial_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class FlacWriter(WavWriter):
+    """Write PCM chunk by chunk as a FLAC file, through an ffmpeg encoder.
+
+    FLAC is lossless, so iter_wav() can rebuild the exact WAV a WavWriter
+    would have written; digests() describe that WAV, not the FLAC bytes.
+    After close(), seek_index holds build_seek_index() for the file;
+    OutputCache.store() writes it to the sidecar next to the master.
+    """
+
+    seek_index = None
+
+    def _open(self, fd):
+        os.close(fd)
+        self._stderr = tempfile.TemporaryFile()
+        self._proc = subprocess.Popen([
+            FFMPEG_BINARY, '-nostdin', '-hide_banner', '-loglevel', 'error', '-y',
+            '-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', str(CHANNELS), '-i', 'pipe:0',
+            '-c:a', 'flac', '-f', 'flac', self._partial_path,
+        ], stdin=subprocess.PIPE, stderr=self._stderr)
+        self._file = self._proc.stdin
+
+    def close(self):
+        self._file.close()
+        returncode = self._proc.wait()
+        self._stderr.seek(0)
+        message = self._stderr.read().decode(errors='replace').strip()
+        self._stderr.close()
+        if returncode != 0:
+            os.remove(self._partial_path)
+            raise RuntimeError(f"ffmpeg FLAC encoder exited with {returncode}: {message}")
+        # Indexed while the file is still in the page cache, for Range requests later
+        self.seek_index = build_seek_index(self._partial_path, app.config['SEEK_INDEX_INTERVAL'])
+        self._finish()
+
+    def abort(self):
+        self._proc.kill()
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        self._proc.wait()
+        self._stderr.close()
+        os.remove(self._partial_path)
+
+def open_output_writer(path):
+    """WavWriter or FlacWriter for path, chosen by its extension."""
+    return FlacWriter(path) if path.endswith('.flac') else WavWriter(path)
+
+def master_filename(filename):
+    """Name of the file stored on disk for the WAV called filename (see CACHE_FORMAT)."""
+    if app.config['CACHE_FORMAT'] == 'flac':
+        return os.path.splitext(filename)[0] + '.flac'
+    return filename
+
+def iter_wav(path, data_size=None, chunk_size=ZIP_CHUNK_SIZE):
+    """Yield the WAV stored at path, decoding it on the fly if it is a FLAC master.
+
+    data_size (PCM bytes) is needed for FLAC masters to build the header;
+    the decoded length is checked against it. Raises RuntimeError on a
+    mismatch or decoder failure.
+    """
+    if not path.endswith('.flac'):
+        with open(path, 'rb') as f:
+            yield from iter(lambda: f.read(chunk_size), b'')
+        return
+
+    yield wav_header(data_size)
+    decoded = 0
+    for chunk in iter_pcm(path, chunk_size=chunk_size):
+        decoded += len(chunk)
+        yield chunk
+    if decoded != data_size:
+        raise RuntimeError(f"{path} decoded to {decoded} bytes, expected {data_size}")
+
+def _crc_table(poly, bits):
+    top = 1 << (bits - 1)
+    mask = (1 << bits) - 1
+    table = []
+    for byte in range(256):
+        crc = byte << (bits - 8)
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly if crc & top else crc << 1) & mask
+        table.append(crc)
+    return table
+
+FLAC_CRC8_TABLE = _crc_table(0x07, 8)
+FLAC_CRC16_TABLE = _crc_table(0x8005, 16)
+
+def flac_crc16(data):
+    """CRC-16 that ends every FLAC frame, computed over the frame before it."""
+    crc = 0
+    for b in data:
+        crc = ((crc << 8) & 0xFFFF) ^ FLAC_CRC16_TABLE[(crc >> 8) ^ b]
+    return crc
+
+# Bumped when build_seek_index() changes, so older sidecar files are rebuilt
+SEEK_INDEX_VERSION = 2
+
+def parse_flac_frame_header(data, pos, fixed_blocksize):
+    """Return (first sample, block size) of a FLAC frame header at pos, or None if there is none.
+
+    The header must carry a matching CRC-8. That still lets about one in 256
+    sync codes inside compressed audio through, so callers must also check
+    that the frame is the one they expect next.
+    """
+    if data[pos] != 0xFF or data[pos + 1] not in (0xF8, 0xF9):
+        return None
+    variable = data[pos + 1] & 1
+    blocksize_code = data[pos + 2] >> 4
+    rate_code = data[pos + 2] & 0x0F
+    if blocksize_code == 0 or rate_code == 0x0F or data[pos + 3] & 1:
+        return None
+    # UTF-8-style coded frame (fixed) or sample (variable) number
+    i = pos + 4
+    first = data[i]
+    if first < 0x80:
+        number, extra = first, 0
+    else:
+        extra = next((n for n in range(1, 7) if first & (0x80 >> (n + 1)) == 0), None)
+        if extra is None or first & (0x80 >> 1) == 0:
+            return None
+        number = first & (0x3F >> extra)
+        for b in data[i + 1:i + 1 + extra]:
+            if b & 0xC0 != 0x80:
+                return None
+            number = (number << 6) | (b & 0x3F)
+    i += 1 + extra
+    if blocksize_code == 1:
+        blocksize = 192
+    elif blocksize_code <= 5:
+        blocksize = 576 << (blocksize_code - 2)
+    elif blocksize_code <= 7:
+        size_bytes = blocksize_code - 5
+        blocksize = int.from_bytes(data[i:i + size_bytes], 'big') + 1
+        i += size_bytes
+    else:
+        blocksize = 256 << (blocksize_code - 8)
+    i += {12: 1, 13: 2, 14: 2}.get(rate_code, 0)
+    crc = 0
+    for b in data[pos:i]:
+        crc = FLAC_CRC8_TABLE[crc ^ b]
+    if crc != data[i]:
+        return None
+    return (number if variable else number * fixed_blocksize), blocksize
+
+def build_seek_index(path, interval):
+    """Map PCM positions of a FLAC file to frame offsets, one point per interval seconds.
+
+    Returns {'version': SEEK_INDEX_VERSION, 'header_size': bytes before the
+    first frame, 'points': [[sample, offset], ...]}.
+    """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if data[:4] != b'fLaC':
+            raise ValueError(f"{path} is not a FLAC file")
+        pos = 4
+        fixed_blocksize = None
+        uniform = False
+        total_samples = None
+        while True:
+            last, block_type = data[pos] >> 7, data[pos] & 0x7F
+            length = int.from_bytes(data[pos + 1:pos + 4], 'big')
+            if block_type == 0:  # STREAMINFO
+                min_blocksize, fixed_blocksize = struct.unpack('>HH', data[pos + 4:pos + 8])
+                uniform = min_blocksize == fixed_blocksize
+                total_samples = int.from_bytes(data[pos + 17:pos + 22], 'big') & 0xFFFFFFFFF
+            pos += 4 + length
+            if last:
+                break
+
+        header_size = pos
+        # Every frame of a stream starts with the same sync code (fixed or variable blocksize)
+        sync = data[pos:pos + 2]
+        points = []
+        next_sample = 0
+        expected = 0
+        previous = None
+        step = interval * SAMPLE_RATE
+        end = len(data) - 16
+        while 0 <= pos < end:
+            frame = parse_flac_frame_header(data, pos, fixed_blocksize)
+            # Frames are contiguous, so only the frame starting at the next
+            # sample is real; any other header is a false sync in audio data.
+            # In a fixed-blocksize stream only the last frame may be shorter.
+            if (frame is not None and frame[0] == expected
+                    and (not uniform or frame[1] == fixed_blocksize
+                         or frame[0] + frame[1] == total_samples)):
+                sample, blocksize = frame
+                expected = sample + blocksize
+                # A seek point must also end the previous frame exactly: its
+                # CRC-16 is the two bytes before this header
+                if sample >= next_sample and (previous is None or flac_crc16(
+                        data[previous:pos - 2]) == int.from_bytes(data[pos - 2:pos], 'big')):
+                    points.append([sample, pos])
+                    next_sample = sample + step
+                previous = pos
+            pos = data.find(sync, pos + 1)
+        return {'version': SEEK_INDEX_VERSION, 'header_size': header_size, 'points': points}
+
+def seek_index_path(master_path):
+    """Sidecar file next to a FLAC master that holds its seek index."""
+    return master_path + '.seek'
+
+def write_seek_index(master_path, seek_index):
+    fd, partial_path = tempfile.mkstemp(dir=os.path.dirname(master_path), suffix='.part')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(seek_index, f)
+    os.replace(partial_path, seek_index_path(master_path))
+
+def load_seek_index(master_path):
+    """Read a FLAC master's seek index, rebuilding the sidecar if it is missing, unreadable or outdated."""
+    try:
+        with open(seek_index_path(master_path)) as f:
+            seek_index = json.load(f)
+        if isinstance(seek_index, dict) and seek_index.get('version') == SEEK_INDEX_VERSION:
+            return seek_index
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        log_error('Could not read seek index, rebuilding it', e)
+    seek_index = build_seek_index(master_path, app.config['SEEK_INDEX_INTERVAL'])
+    write_seek_index(master_path, seek_index)
+    return seek_index
+
+def iter_wav_range(path, data_size, seek_index, start, stop, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield bytes start..stop-1 of the WAV rebuilt from a FLAC master.
+
+    Decoding starts at the last seek point before start: the FLAC header and
+    the frames from that point on are piped to ffmpeg, so only the frames
+    that cover the range (plus at most one seek interval) are decoded.
+    """
+    header = wav_header(data_size)
+    if start < len(header):
+        yield header[start:stop]
+        start = len(header)
+    if start >= stop:
+        return
+
+    frame_bytes = CHANNELS * SAMPLE_WIDTH
+    pcm_start = start - len(header)
+    point_sample, point_offset = seek_index['points'][0]
+    for sample, offset in seek_index['points']:
+        if sample * frame_bytes > pcm_start:
+            break
+        point_sample, point_offset = sample, offset
+    skip = pcm_start - point_sample * frame_bytes
+    remaining = stop - start
+
+    proc = subprocess.Popen([
+        FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-f', 'flac', '-i', 'pipe:0',
+        '-acodec', AUDIO_CODEC, '-f', 's16le', 'pipe:1',
+    ], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def feed():
+        try:
+            with open(path, 'rb') as f:
+                proc.stdin.write(f.read(seek_index['header_size']))
+                f.seek(point_offset)
+                for chunk in iter(lambda: f.read(ZIP_CHUNK_SIZE), b''):
+                    proc.stdin.write(chunk)
+        except (BrokenPipeError, ValueError):
+            pass  # the reader has what it needs and stopped the decoder
+        finally:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        while remaining > 0:
+            chunk = proc.stdout.read(chunk_size)
+            if not chunk:
+                raise RuntimeError(f"{path} ended before byte {stop}")
+            if skip:
+                dropped = min(skip, len(chunk))
+                chunk = chunk[dropped:]
+                skip -= dropped
+            chunk = chunk[:remaining]
+            remaining -= len(chunk)
+            if chunk:
+                yield chunk
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        proc.stdout.close()
+        feeder.join()
+
+def crc32_combine(crc1, crc2, len2):
+    """CRC-32 of A + B given crc32(A), crc32(B) and len(B), as zlib's crc32_combine()."""
+    def times(matrix, vector):
+        result = 0
+        i = 0
+        while vector:
+            if vector & 1:
+                result ^= matrix[i]
+            vector >>= 1
+            i += 1
+        return result
+
+    def square(matrix):
+        return [times(matrix, matrix[n]) for n in range(32)]
+
+    if len2 <= 0:
+        return crc1
+    # Operator for one zero bit, then squared up to four zero bits
+    odd = [0xEDB88320] + [1 << n for n in range(31)]
+    even = square(odd)
+    odd = square(even)
+    # Apply len2 zero bytes to crc1, one bit of len2 at a time
+    while True:
+        even = square(odd)
+        if len2 & 1:
+            crc1 = times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+        odd = square(even)
+        if len2 & 1:
+            crc1 = times(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+    return crc1 ^ crc2
+
+def file_digests(path, data_size=None):
+    """Recompute WavWriter.digests() for a WAV (or FLAC master) on disk."""
+    crc = 0
+    sha256 = hashlib.sha256()
+    header_left = len(wav_header())
+    for chunk in iter_wav(path, data_size):
+        crc = zlib.crc32(chunk, crc)
+        if header_left:
+            skipped = min(header_left, len(chunk))
+            chunk = chunk[skipped:]
+            header_left -= skipped
+        sha256.update(chunk)
+    return {'crc32': crc, 'sha256': sha256.hexdigest()}
+
+def transcode_to_wav(source_path, output_path, duration=None, progress=None, start=None, limit=None):
+    """Decode the source audio once and write the final WAV chunk by chunk.
+
+    A .flac output_path stores the same PCM as a FLAC master instead.
+    start/limit (seconds) convert only a section of the source.
+    Returns the finished writer (data_size, digests()).
+    """
+    with open_output_writer(output_path) as writer:
+        for chunk in iter_pcm(source_path, duration=duration, progress=progress, start=start, limit=limit):
+            writer.write(chunk)
+    return writer
+
+def guard_body(chunks, message):
+    """Yield a response body from chunks, logging a failure instead of raising it."""
+    try:
+        yield from chunks
+    except Exception as e:
+        # Headers are already sent; ending the body early is all we can do
+        log_error(message, e)
+
+def stream_wav(source, http_headers=None, cache_path=None, on_cached=None):
+    """Yield a WAV header followed by PCM chunks as ffmpeg decodes them.
+
+    If cache_path is given the stream is also written there (as WAV or a
+    FLAC master, by extension), and on_cached(writer) is called once the
+    file is complete.
+    """
+    return guard_body(_stream_wav(source, http_headers, cache_path, on_cached),
+                      'Streaming decode failed')
+
+def _stream_wav(source, http_headers, cache_path, on_cached):
+    writer = open_output_writer(cache_path) if cache_path else None
+    pcm = iter_pcm(source, http_headers, chunk_size=STREAM_CHUNK_SIZE)
+    complete = False
+    try:
+        yield wav_header()
+        for chunk in pcm:
+            if writer:
+                writer.write(chunk)
+            yield chunk
+        complete = True
+    finally:
+        pcm.close()
+        if writer:
+            if complete:
+                writer.close()
+                if on_cached:
+                    on_cached(writer)
+            else:
+                writer.abort()
+
+def dos_timestamp(mtime):
+    """ZIP (time, date) fields for a POSIX timestamp."""
+    t = time.localtime(max(mtime, 315532800))  # DOS dates start in 1980
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+def stream_zip(members):
+    """Yield a stored (uncompressed) ZIP64 archive.
+
+    members is a list of (arcname, size, mtime, crc32, chunks) tuples, where
+    chunks lazily yields the member's bytes (e.g. iter_wav()). When the CRC
+    is already known it goes in the local header; otherwise it is computed
+    while the member is sent and written in a data descriptor after it.
+    Only one chunk and the central directory entries are held in memory.
+    """
+    central = []
+    offset = 0
+    for arcname, size, mtime, crc, chunks in members:
+        name = arcname.encode('utf-8')
+        dos_time, dos_date = dos_timestamp(mtime)
+        # Bit 11: UTF-8 name; bit 3: CRC follows the data
+        flags = 0x0800 if crc is not None else 0x0808
+        extra = struct.pack('<HHQQ', 0x0001, 16, size, size)
+        header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 45, flags, 0, dos_time, dos_date,
+                             crc or 0, 0xFFFFFFFF, 0xFFFFFFFF, len(name), len(extra)) + name + extra
+        yield header
+
+        running_crc = 0
+        sent = 0
+        for chunk in chunks:
+            if crc is None:
+                running_crc = zlib.crc32(chunk, running_crc)
+            sent += len(chunk)
+            yield chunk
+        if sent != size:
+            raise IOError(f"{arcname} was {sent} bytes, expected {size}")
+        written = len(header) + size
+        if crc is None:
+            crc = running_crc
+            descriptor = struct.pack('<IIQQ', 0x08074b50, crc, size, size)
+            yield descriptor
+            written += len(descriptor)
+
+        extra = struct.pack('<HHQQQ', 0x0001, 24, size, size, offset)
+        central.append(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | 45, 45, flags, 0,
+                                   dos_time, dos_date, crc, 0xFFFFFFFF, 0xFFFFFFFF, len(name),
+                                   len(extra), 0, 0, 0, 0o100644 << 16, 0xFFFFFFFF) + name + extra)
+        offset += written
+
+    directory = b''.join(central)
+    yield directory
+    count = len(central)
+    eocd64_offset = offset + len(directory)
+    yield struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, len(directory), offset)
+    yield struct.pack('<IIQI', 0x07064b50, 0, eocd64_offset, 1)
+    yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0)
+
+def describe_download_error(e):
+    """Map a yt-dlp DownloadError to a user-facing message and HTTP status."""
+    if 'Private video' in str(e):
+        return 'This video is private and cannot be downloaded', 403
+    elif 'Video unavailable' in str(e):
+        return 'This video is unavailable or restricted', 404
+    elif 'Unsupported URL' in str(e):
+        return 'Unsupported URL. Please provide a valid YouTube URL', 400
+    else:
+        return 'Error downloading video. Please try again later.', 500
+
+def download_error_response(e):
+    """Map a yt-dlp DownloadError to a JSON error response."""
+    message, status = describe_download_error(e)
+    return jsonify({'error': message}), status
+
+class ConversionError(Exception):
+    """A conversion failed for a reason that can be shown to the user."""
+
+class OutputCache:
+    """Index of finished WAVs in TEMP_AUDIO_DIR keyed by cache_key().
+
+    Each entry is served under its WAV filename; the file on disk (the
+    master) is either that WAV or a FLAC of the same audio.
+    The index is persisted as JSON next to the files so hits survive a
+    restart. Entries whose file has disappeared are dropped on lookup.
+    Files that are currently being served are pinned and never evicted.
+    Digests recorded at write time let identical audio share one file
+    (hard links) and let verify() detect corruption later.
+    """
+
+    def __init__(self, directory, index_name='cache_index.json'):
+        self.directory = directory
+        self._index_path = os.path.join(directory, index_name)
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._keys_by_filename = {}
+        self._pins = Counter()
+        self.hits = 0
+        self.misses = 0
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self.deduplicated_bytes = 0
+        self.corrupt_files = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self._index_path) as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            log_error('Could not read cache index, starting empty', e)
+        for entry in self._entries.values():
+            # Older indexes kept seek indexes inline; they now live in sidecar files
+            entry.pop('seek_index', None)
+        self._keys_by_filename = {e['result']['filename']: k for k, e in self._entries.items()}
+
+    def _save(self):
+        partial_path = self._index_path + '.tmp'
+        with open(partial_path, 'w') as f:
+            json.dump(self._entries, f)
+        os.replace(partial_path, self._index_path)
+
+    def lookup(self, key, count_miss=True):
+        """Return the cached result for key, or None on a miss.
+
+        count_miss=False leaves a miss out of the stats, for a check that a
+        later lookup of the same key will repeat.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and not os.path.isfile(self.master_path(entry)):
+                del self._entries[key]
+                self._save()
+                entry = None
+            if entry is None:
+                if count_miss:
+                    self.misses += 1
+                return None
+            self.hits += 1
+            entry['last_used'] = time.time()
+            return dict(entry['result'])
+
+    def store(self, key, result, writer=None, master=None):
+        """Record a finished file written by writer (a WavWriter or FlacWriter).
+
+        master is the name of the file on disk if it is not writer.path.
+        """
+        master = master or (os.path.basename(writer.path) if writer else result['filename'])
+        path = os.path.join(self.directory, master)
+        size = os.path.getsize(path)
+        now = time.time()
+        digests = writer.digests() if writer else {}
+        if getattr(writer, 'seek_index', None):
+            write_seek_index(path, writer.seek_index)
+        with self._lock:
+            if digests.get('sha256'):
+                self._link_duplicate(path, size, digests['sha256'])
+            entry = {'result': dict(result), 'size': size,
+                     'crc32': digests.get('crc32'), 'sha256': digests.get('sha256'),
+                     'created_at': now, 'last_used': now, 'verified_at': now}
+            if writer:
+                entry['data_size'] = writer.data_size
+            if master != result['filename']:
+                entry['master'] = master
+            self._entries[key] = entry
+            self._keys_by_filename[result['filename']] = key
+            self._save()
+
+    def master_path(self, entry):
+        """Path of the file on disk behind an index entry."""
+        return os.path.join(self.directory, entry.get('master', entry['result']['filename']))
+
+    def _remove_master(self, entry):
+        """Delete the file behind an entry and its seek index sidecar, if any."""
+        path = self.master_path(entry)
+        for p in (path, seek_index_path(path)):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+
+    def _link_duplicate(self, path, size, sha256):
+        """Replace path with a hard link to an existing file holding the same audio."""
+        for entry in self._entries.values():
+            if entry.get('sha256') != sha256 or entry['size'] != size:
+                continue
+            existing = self.master_path(entry)
+            if (existing == path or os.path.splitext(existing)[1] != os.path.splitext(path)[1]
+                    or not os.path.isfile(existing)):
+                continue
+            partial_path = path + '.part'
+            try:
+                os.link(existing, partial_path)
+                os.replace(partial_path, path)
+            except OSError as e:
+                log_error('Could not deduplicate cached file', e)
+                return
+            self.deduplicated_bytes += size
+            return
+
+    def _unique_size(self, entries):
+        """Bytes on disk for entries, counting hard-linked duplicates once."""
+        seen = set()
+        total = 0
+        for e in entries:
+            digest = e.get('sha256') or e['result']['filename']
+            if digest not in seen:
+                seen.add(digest)
+                total += e['size']
+        return total
+
+    def verify(self, key):
+        """Re-read a cached file and compare it with its recorded digests.
+
+        Returns True if it matches, False if it was corrupt (the entry and
+        file are then removed) and None if there is nothing to check.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry or entry.get('crc32') is None:
+                return None
+            filename = entry['result']['filename']
+        path = self.master_path(entry)
+        try:
+            actual = file_digests(path, entry.get('data_size'))
+        except (OSError, RuntimeError):
+            actual = None
+        with self._lock:
+            if self._entries.get(key) is not entry:
+                return None
+            if (actual and actual['crc32'] == entry['crc32']
+                    and entry.get('sha256') in (None, actual['sha256'])):
+                entry['verified_at'] = time.time()
+                self._save()
+                return True
+            self.corrupt_files += 1
+            del self._entries[key]
+            self._keys_by_filename.pop(filename, None)
+            if filename not in self._pins:
+                self._remove_master(entry)
+            self._save()
+            return False
+
+    def next_to_verify(self, min_age):
+        """Key of the unpinned entry checked longest ago, if that was over min_age seconds."""
+        with self._lock:
+            candidates = [(e.get('verified_at', e['created_at']), k) for k, e in self._entries.items()
+                          if e.get('crc32') is not None and e['result']['filename'] not in self._pins]
+        if not candidates:
+            return None
+        verified_at, key = min(candidates)
+        return key if time.time() - verified_at > min_age else None
+
+    def file_entry(self, filename):
+        """Index entry (size, crc32, ...) for a cached file, or None."""
+        with self._lock:
+            entry = self._entries.get(self._keys_by_filename.get(filename))
+            return dict(entry) if entry else None
+
+    def pin(self, filename):
+        """Mark a file as being served so the janitor leaves it alone."""
+        with self._lock:
+            self._pins[filename] += 1
+            self._touch(filename)
+
+    def touch(self, filename):
+        """Mark a file as just used so it is the last to be evicted."""
+        with self._lock:
+            self._touch(filename)
+
+    def _touch(self, filename):
+        key = self._keys_by_filename.get(filename)
+        if key in self._entries:
+            self._entries[key]['last_used'] = time.time()
+
+    def unpin(self, filename):
+        with self._lock:
+            self._pins[filename] -= 1
+            if self._pins[filename] <= 0:
+                del self._pins[filename]
+
+    def evict(self, max_bytes=0, max_age=0):
+        """Delete least-recently-used files until the cache fits max_bytes.
+
+        Entries unused for more than max_age seconds are removed first.
+        A limit of 0 disables it. Pinned files are skipped.
+        """
+        with self._lock:
+            now = time.time()
+            total = self._unique_size(self._entries.values())
+            candidates = sorted(
+                (k for k, e in self._entries.items() if e['result']['filename'] not in self._pins),
+                key=lambda k: self._entries[k].get('last_used', 0))
+            evicted = []
+            for key in candidates:
+                entry = self._entries[key]
+                expired = max_age and now - entry.get('last_used', 0) > max_age
+                over_budget = max_bytes and total > max_bytes
+                if not (expired or over_budget):
+                    continue
+                self._remove_master(entry)
+                del self._entries[key]
+                self._keys_by_filename.pop(entry['result']['filename'], None)
+                shared = entry.get('sha256') and any(
+                    e.get('sha256') == entry['sha256'] for e in self._entries.values())
+                if not shared:
+                    # Only the last link to the audio actually frees space
+                    total -= entry['size']
+                    self.evicted_bytes += entry['size']
+                self.evicted_files += 1
+                evicted.append(entry['result']['filename'])
+            if evicted:
+                self._save()
+            return evicted
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._unique_size(self._entries.values()),
+                'pinned': len(self._pins),
+                'evicted_files': self.evicted_files,
+                'evicted_bytes': self.evicted_bytes,
+                'deduplicated_bytes': self.deduplicated_bytes,
+                'corrupt_files': self.corrupt_files,
+            }
+
+class MetadataCache:
+    """LRU cache of video metadata recorded from full extractions, keyed by URL.
+
+    Its one reader is lookup_cached_output(), which maps a URL that
+    extract_video_id() does not recognise to its video id, so a repeat
+    request can be answered from the output cache without contacting the
+    site. URLs extract_video_id() does recognise are therefore not stored.
+    Entries expire after ttl. If db_path is set, entries are also persisted
+    to SQLite and survive restarts.
+    """
+
+    def __init__(self, max_entries, ttl, db_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if db_path:
+            with sqlite3.connect(db_path) as db:
+                db.execute('CREATE TABLE IF NOT EXISTS metadata '
+                           '(key TEXT PRIMARY KEY, data TEXT NOT NULL, fetched_at REAL NOT NULL)')
+
+    def get(self, url, count_miss=True):
+        """Return recorded metadata for url, or None. Never fetches."""
+        key = url
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+        if entry is None:
+            entry = self._load(key)
+
+        with self._lock:
+            if entry and time.time() - entry[1] < self.ttl:
+                self.hits += 1
+                return dict(entry[0])
+            if count_miss:
+                self.misses += 1
+        return None
+
+    def put(self, url, info):
+        """Record metadata from a full extraction of url, unless nothing would read it."""
+        if not extract_video_id(url):
+            self._put(url, slim_metadata(info))
+
+    def _put(self, key, info, fetched_at=None):
+        entry = (info, fetched_at or time.time())
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if self.db_path and fetched_at is None:
+            with sqlite3.connect(self.db_path) as db:
+                db.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?)',
+                           (key, json.dumps(info), entry[1]))
+
+    def _load(self, key):
+        if not self.db_path:
+            return None
+        with sqlite3.connect(self.db_path) as db:
+            row = db.execute('SELECT data, fetched_at FROM metadata WHERE key = ?', (key,)).fetchone()
+        if not row:
+            return None
+        info = json.loads(row[0])
+        self._put(key, info, fetched_at=row[1])
+        return info, row[1]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+            }
+
+def slim_metadata(info):
+    """Keep only the fields MetadataCache stores from a yt-dlp info dict."""
+    return {k: info[k] for k in ('id', 'title', 'uploader', 'duration') if info.get(k) is not None}
+
+def process_scratch_dir():
+    """This process's directory under SCRATCH_DIR, created on first use.
+
+    Looked up per call rather than at import, so forked workers each get
+    their own.
+    """
+    path = os.path.join(SCRATCH_DIR, str(os.getpid()))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def remove_orphaned_scratch():
+    """Delete scratch directories left behind by processes that no longer run."""
+    try:
+        entries = list(os.scandir(SCRATCH_DIR))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.name.isdigit():
+            try:
+                os.kill(int(entry.name), 0)
+                continue
+            except PermissionError:
+                continue  # alive, owned by someone else
+            except ProcessLookupError:
+                pass
+        shutil.rmtree(entry.path, ignore_errors=True)
+        logger.info(f"Removed orphaned scratch directory {entry.name}")
+
+def remove_stale_partials(directory, max_age):
+    """Delete leftover .part files that have not been written to for max_age seconds."""
+    cutoff = time.time() - max_age
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.name.endswith('.part') and entry.stat().st_mtime < cutoff:
+            try:
+                os.remove(entry.path)
+                logger.info(f"Removed stale partial file {entry.name}")
+            except OSError as e:
+                log_error(f'Could not remove {entry.name}', e)
+
+def run_janitor():
+    """Periodically enforce the cache byte budget and maximum idle age.
+
+    Each run also re-verifies the cached file that was checked longest ago,
+    so corruption is found at the cost of one file read per interval.
+    """
+    while True:
+        time.sleep(app.config['JANITOR_INTERVAL'])
+        try:
+            evicted = output_cache.evict(app.config['CACHE_MAX_BYTES'], app.config['CACHE_MAX_AGE'])
+            if evicted:
+                logger.info(f"Janitor evicted {len(evicted)} cached file(s)")
+            if app.config['CACHE_MAX_AGE']:
+                remove_stale_partials(TEMP_AUDIO_DIR, app.config['CACHE_MAX_AGE'])
+            if app.config['CACHE_VERIFY_INTERVAL']:
+                key = output_cache.next_to_verify(app.config['CACHE_VERIFY_INTERVAL'])
+                if key and output_cache.verify(key) is False:
+                    logger.warning(f"Janitor removed corrupt cached file for {key}")
+        except Exception as e:
+            log_error('Janitor run failed', e, exc_info=True)
+
+class Job:
+    """A single conversion request tracked by the JobQueue."""
+
+    def __init__(self, url, key=None, clip=None):
+        self.id = uuid.uuid4().hex
+        self.url = url
+        self.key = key
+        self.clip = clip
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.error_status = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.info = None
+        self.source = None
+        self.cost = UNKNOWN_DURATION_COST
+        self.memory = 0
+        self.host = urlparse(url).netloc.lower()
+        self.queued_at = self.created_at
+        self.progress = {'stage': 'queued'}
+        self.version = 0
+        self._changed = threading.Condition()
+
+    def _notify(self):
+        with self._changed:
+            self.version += 1
+            self._changed.notify_all()
+
+    def start(self):
+        self.status = 'running'
+        self.started_at = time.time()
+        self.update_progress(stage='starting')
+
+    def finish(self, result):
+        self.result = result
+        self.status = 'done'
+        self.finished_at = time.time()
+        self.update_progress(stage='done')
+
+    def fail(self, message, status=500):
+        self.error = message
+        self.error_status = status
+        self.status = 'failed'
+        self.finished_at = time.time()
+        self.update_progress(stage='failed')
+
+    def update_progress(self, **fields):
+        self.progress = dict(self.progress, **fields)
+        self._notify()
+
+    def wait_for_change(self, version, timeout):
+        """Block until the job changes past version; return the current version."""
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    @property
+    def is_finished(self):
+        return self.status in ('done', 'failed')
+
+    @property
+    def percent(self):
+        """Overall completion: downloading is the first half, converting the second."""
+        stage = self.progress.get('stage')
+        if self.is_finished:
+            return 100.0
+        if stage in ('downloading', 'downloaded', 'postprocessing', 'waiting_for_cpu'):
+            total = self.progress.get('total_bytes')
+            done = self.progress.get('downloaded_bytes') or 0
+            return 50.0 * min(1.0, done / total) if total else 0.0
+        if stage == 'converting':
+            return 50.0 + (self.progress.get('transcode_percent') or 0.0) / 2
+        return 0.0
+
+    def to_dict(self):
+        data = {'job_id': self.id, 'status': self.status, 'url': self.url, 'progress': self.progress}
+        if self.clip:
+            data['clip'] = {'start': self.clip[0], 'end': self.clip[1]}
+        if self.status == 'done':
+            data['result'] = self.result
+        elif self.status == 'failed':
+            data['error'] = self.error
+        return data
+
+class Batch:
+    """A group of jobs submitted together and tracked as one.
+
+    A playlist or channel batch is created with its url and no jobs; they
+    are added once a resolve worker has expanded the URL.
+    """
+
+    def __init__(self, jobs, url=None):
+        self.id = uuid.uuid4().hex
+        self.jobs = jobs
+        self.url = url
+        self.title = None
+        self.expanding = url is not None
+        self.error = None
+        self.error_status = None
+        self.retry_after = None
+        self.created_at = time.time()
+        self._revision = 0
+
+    def expanded(self, title, jobs):
+        self.title = title
+        self.jobs = jobs
+        self.expanding = False
+        self._revision += 1
+
+    def fail(self, message, status=500):
+        self.error = message
+        self.error_status = status
+        self.expanding = False
+        self._revision += 1
+
+    @property
+    def is_finished(self):
+        return not self.expanding and all(j.is_finished for j in self.jobs)
+
+    @property
+    def finished_at(self):
+        return max((j.finished_at for j in self.jobs), default=self.created_at)
+
+    @property
+    def version(self):
+        """Changes whenever the batch or any job in it changes."""
+        return self._revision + sum(j.version for j in self.jobs)
+
+    def to_dict(self):
+        counts = Counter(j.status for j in self.jobs)
+        if self.error:
+            status = 'failed'
+        elif self.expanding:
+            status = 'expanding'
+        else:
+            status = 'done' if self.is_finished else 'running'
+        data = {
+            'batch_id': self.id,
+            'status': status,
+            'total': len(self.jobs),
+            'counts': {status: counts.get(status, 0) for status in ('queued', 'running', 'done', 'failed')},
+            'percent': round(sum(j.percent for j in self.jobs) / len(self.jobs), 1) if self.jobs else 0.0,
+            'jobs': [j.to_dict() for j in self.jobs],
+        }
+        if self.title:
+            data['playlist_title'] = self.title
+        if self.error:
+            data['error'] = self.error
+        if self.retry_after:
+            data['retry_after'] = self.retry_after
+        return data
+
+class WorkerPool:
+    """A fixed set of threads consuming jobs from a queue.
+
+    The threads run once start() is called; jobs put() before that wait in
+    the queue. With maxsize set, put() blocks while the queue is full,
+    which pushes back on whoever is feeding the pool.
+    """
+
+    def __init__(self, name, workers, handler, maxsize=0):
+        self.name = name
+        self.workers = workers
+        self.maxsize = maxsize
+        self.active = 0
+        self._handler = handler
+        self._pending = deque()
+        self._cond = threading.Condition()
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, args=(i,), name=f'{self.name}-worker-{i}', daemon=True).start()
+
+    def put(self, job):
+        with self._cond:
+            while self.maxsize and len(self._pending) >= self.maxsize:
+                self._cond.wait()
+            job.queued_at = time.time()
+            self._pending.append(job)
+            self._cond.notify_all()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _next_job(self, worker_index):
+        """Pick the job worker_index should run next, or None to keep waiting."""
+        return self._pending.popleft() if self._pending else None
+
+    def _worker(self, worker_index):
+        while True:
+            with self._cond:
+                job = self._next_job(worker_index)
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job(worker_index)
+                self.active += 1
+                # Wake a producer blocked on a full queue
+                self._cond.notify_all()
+            try:
+                self._handler(job)
+            except Exception as e:
+                log_error(f'{self.name} worker crashed on job {job.id}', e, exc_info=True)
+            finally:
+                with self._cond:
+                    self.active -= 1
+                    self._job_done(job)
+
+    def _job_done(self, job):
+        """Called with the pool lock held after a job's handler returns."""
+
+class ShortestJobFirstPool(WorkerPool):
+    """WorkerPool that runs the cheapest queued job first.
+
+    A job's priority is its estimated cost (job.cost, seconds of audio)
+    minus aging_rate for every second it has been queued, so long jobs are
+    not starved. The first fast_lane workers only take jobs costing at most
+    short_job_cost, so short jobs always have a worker even while every
+    other worker is busy with long ones. With per_host_limit set, the
+    other workers run at most that many jobs for the same job.host at once;
+    fast-lane workers are exempt, or a busy host could take their slot too.
+    """
+
+    def __init__(self, name, workers, handler, fast_lane=1, short_job_cost=600, aging_rate=10,
+                 per_host_limit=0, maxsize=0):
+        # Never reserve every worker, or long jobs could not run at all
+        self.fast_lane = max(0, min(fast_lane, workers - 1))
+        self.short_job_cost = short_job_cost
+        self.aging_rate = aging_rate
+        self.per_host_limit = per_host_limit
+        self._host_active = Counter()
+        super().__init__(name, workers, handler, maxsize)
+
+    def _next_job(self, worker_index):
+        candidates = self._pending
+        if worker_index < self.fast_lane:
+            candidates = [j for j in candidates if j.cost <= self.short_job_cost]
+        elif self.per_host_limit:
+            candidates = [j for j in candidates if self._host_active[j.host] < self.per_host_limit]
+        if not candidates:
+            return None
+        now = time.time()
+        job = min(candidates, key=lambda j: j.cost - self.aging_rate * (now - j.queued_at))
+        self._pending.remove(job)
+        self._host_active[job.host] += 1
+        return job
+
+    def _job_done(self, job):
+        self._host_active[job.host] -= 1
+        if self._host_active[job.host] <= 0:
+            del self._host_active[job.host]
+        # A slot for this host is free again
+        self._cond.notify_all()
+
+class MemoryBudgetPool(WorkerPool):
+    """WorkerPool that admits jobs while their estimated memory fits a budget.
+
+    Each job carries job.memory, its estimated peak in bytes. A queued job
+    starts only if it fits next to the jobs already running, so concurrency
+    follows the budget and the worker count is only an upper bound. Smaller
+    jobs may start ahead of a queued job that does not fit yet, unless that
+    job has waited longer than starvation_seconds; then nothing else is
+    admitted until memory frees up for it. A job larger than the whole
+    budget runs alone.
+    """
+
+    def __init__(self, name, workers, handler, budget, starvation_seconds=60, maxsize=0):
+        self.budget = budget
+        self.starvation_seconds = starvation_seconds
+        self.reserved = 0
+        self.peak_reserved = 0
+        self.deferred = 0
+        super().__init__(name, workers, handler, maxsize)
+
+    def _fits(self, job):
+        return self.reserved == 0 or self.reserved + job.memory <= self.budget
+
+    def _next_job(self, worker_index):
+        if not self._pending:
+            return None
+        oldest = self._pending[0]
+        if time.time() - oldest.queued_at > self.starvation_seconds:
+            candidates = [oldest]
+        else:
+            candidates = self._pending
+        job = next((j for j in candidates if self._fits(j)), None)
+        if job is None:
+            self.deferred += 1
+            return None
+        self._pending.remove(job)
+        self.reserved += job.memory
+        self.peak_reserved = max(self.peak_reserved, self.reserved)
+        return job
+
+    def _job_done(self, job):
+        self.reserved -= job.memory
+        # Freed memory may let a waiting worker admit a job
+        self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'budget_bytes': self.budget,
+                'reserved_bytes': self.reserved,
+                'peak_reserved_bytes': self.peak_reserved,
+                'deferred': self.deferred,
+            }
+
+class QueueFullError(Exception):
+    """Raised by JobQueue.submit() when admission control rejects a job."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Job queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+class JobQueue:
+    """Run jobs through a pipeline of background worker pools.
+
+    1. resolve: check the output cache and extract the video's info dict,
+       which gives its duration before anything expensive starts. The
+       same workers expand playlist and channel URLs into batches.
+    2. download: network-bound, many workers, scheduled shortest-job-first
+       by duration with aging and a reserved fast lane for short jobs, and
+       capped per source host.
+    3. transcode: CPU-bound, at most one worker per core, and admitted
+       against a memory budget using each job's estimated peak. A bounded
+       queue sits in front of it; when it is full, download workers wait
+       before handing over, so a burst of downloads cannot oversubscribe
+       the CPUs or memory.
+
+    Each stage handler returns True when the job should move on to the
+    next stage. Submissions that share a key with a job that is still
+    queued or running are coalesced onto that job (single-flight), so
+    concurrent requests for the same output do the work once. New work is
+    refused with QueueFullError once max_active jobs are unfinished or
+    max_queued are waiting for a resolve or download worker. Finished jobs
+    are kept for JOB_RETENTION seconds so clients can poll their status,
+    then dropped.
+    """
+
+    # Window over which the drain rate for Retry-After is measured
+    DRAIN_WINDOW = 300
+
+    def __init__(self, resolve_handler, download_handler, transcode_handler, resolve_workers,
+                 download_workers, transcode_workers, transcode_queue_size, fast_lane_workers=1,
+                 short_job_seconds=600, aging_rate=10, per_host_limit=0, memory_budget=2 * 1024 ** 3,
+                 max_active=0, max_queued=0, expand_handler=None):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self._jobs = {}
+        self._batches = {}
+        self._inflight = {}
+        self._active = 0
+        self._completions = deque()
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.transcode_pool = MemoryBudgetPool(
+            'transcode', transcode_workers, self._stage(transcode_handler),
+            budget=memory_budget, maxsize=transcode_queue_size)
+        self.download_pool = ShortestJobFirstPool(
+            'download', download_workers,
+            self._stage(download_handler, self.transcode_pool, 'waiting_for_cpu'),
+            fast_lane=fast_lane_workers, short_job_cost=short_job_seconds, aging_rate=aging_rate,
+            per_host_limit=per_host_limit)
+        self._resolve = self._stage(resolve_handler, self.download_pool, 'waiting_for_download', first=True)
+        self._expand_handler = expand_handler
+        self.resolve_pool = WorkerPool('resolve', resolve_workers, self._resolve_or_expand)
+
+    def start(self):
+        """Start the worker threads of every stage."""
+        for pool in (self.transcode_pool, self.download_pool, self.resolve_pool):
+            pool.start()
+
+    def submit(self, url, key=None, clip=None):
+        with self._lock:
+            self.submitted += 1
+            job = self._coalesce(url, key)
+            if job:
+                return job
+            self._admit()
+            job = self._create(url, key, clip)
+        self.resolve_pool.put(job)
+        logger.info(f"Queued job {job.id} for {url}")
+        return job
+
+    def record_hit(self, url, result, clip=None):
+        """Register a job that is already done because its output was cached.
+
+        Nothing is queued and no admission limit applies.
+        """
+        job = Job(url, clip=clip)
+        job.finish(result)
+        with self._lock:
+            self.submitted += 1
+            self._prune()
+            self._jobs[job.id] = job
+        return job
+
+    def submit_batch(self, entries):
+        """Submit (url, key) pairs as one Batch.
+
+        The batch is admitted only if all of its new jobs fit within
+        max_active and max_queued; otherwise none of it is queued.
+        """
+        with self._lock:
+            self.submitted += len(entries)
+            self._admit(self._count_new(entries))
+            jobs, new_jobs = self._add_entries(entries)
+            batch = Batch(jobs)
+            self._batches[batch.id] = batch
+        for job in new_jobs:
+            self.resolve_pool.put(job)
+        logger.info(f"Queued batch {batch.id} with {len(new_jobs)} new job(s) for {len(entries)} URL(s)")
+        return batch
+
+    def submit_collection(self, url):
+        """Queue a playlist or channel URL as a Batch that fills in once expanded.
+
+        The expansion runs on a resolve worker so the caller gets the batch
+        back at once. It takes one queue slot until then; its entries are
+        admitted as a whole once they are known, and the batch fails with
+        retry_after set if they do not fit.
+        """
+        with self._lock:
+            self._admit()
+            batch = Batch([], url=url)
+            self._batches[batch.id] = batch
+        self.resolve_pool.put(batch)
+        logger.info(f"Queued batch {batch.id} for expansion of {url}")
+        return batch
+
+    def _add_entries(self, entries):
+        """Coalesce or create a job per (url, key); returns (all jobs, new jobs). Needs the lock."""
+        jobs = []
+        new_jobs = []
+        for url, key in entries:
+            job = self._coalesce(url, key)
+            if not job:
+                job = self._create(url, key)
+                new_jobs.append(job)
+            jobs.append(job)
+        return jobs, new_jobs
+
+    def _resolve_or_expand(self, item):
+        if isinstance(item, Batch):
+            self._expand(item)
+        else:
+            self._resolve(item)
+
+    def _expand(self, batch):
+        """Turn a collection batch into jobs; expand_handler fails the batch itself on error."""
+        expansion = self._expand_handler(batch)
+        if expansion is None:
+            return
+        title, entries = expansion
+        with self._lock:
+            self.submitted += len(entries)
+            try:
+                self._admit(self._count_new(entries))
+            except QueueFullError as e:
+                logger.warning(f"Rejected expanded batch {batch.id}: {str(e)}")
+                batch.retry_after = e.retry_after
+                batch.fail('The server is busy. Please try again shortly.', 429)
+                return
+            jobs, new_jobs = self._add_entries(entries)
+        batch.expanded(title, jobs)
+        for job in new_jobs:
+            self.resolve_pool.put(job)
+        logger.info(f"Expanded batch {batch.id} into {len(new_jobs)} new job(s) for {len(entries)} URL(s)")
+
+    def _coalesce(self, url, key):
+        job = self._inflight.get(key) if key else None
+        if job:
+            self.coalesced += 1
+            logger.info(f"Coalesced request for {url} onto job {job.id}")
+        return job
+
+    def _count_new(self, entries):
+        """How many jobs entries would create; the rest coalesce onto running ones. Needs the lock."""
+        keys = {key for _, key in entries if key and key not in self._inflight}
+        return len(keys) + sum(1 for _, key in entries if not key)
+
+    def _admit(self, count=1):
+        """Raise QueueFullError unless count more jobs fit within max_active and max_queued."""
+        if not count:
+            return
+        queued = len(self.resolve_pool) + len(self.download_pool)
+        if (self.max_active and self._active + count > self.max_active) or \
+                (self.max_queued and queued + count > self.max_queued):
+            self.rejected += 1
+            raise QueueFullError(self._retry_after(queued, count))
+
+    @property
+    def max_batch_size(self):
+        """Most new jobs one batch can ever be admitted with (0 = unlimited)."""
+        return min((n for n in (self.max_active, self.max_queued) if n), default=0)
+
+    def _create(self, url, key, clip=None):
+        job = Job(url, key, clip)
+        self._active += 1
+        self._prune()
+        self._jobs[job.id] = job
+        if key:
+            self._inflight[key] = job
+        return job
+
+    def drain_rate(self):
+        """Jobs finished per second over (at most) the last DRAIN_WINDOW seconds."""
+        now = time.time()
+        while self._completions and self._completions[0] < now - self.DRAIN_WINDOW:
+            self._completions.popleft()
+        if not self._completions:
+            return 0.0
+        # Measure over the span actually observed so a fresh server is not underestimated
+        return len(self._completions) / max(10.0, now - self._completions[0])
+
+    def _retry_after(self, queued, count=1):
+        """Seconds until the current backlog should have drained enough to admit count more jobs."""
+        rate = self.drain_rate()
+        if not rate:
+            return app.config['RETRY_AFTER_DEFAULT']
+        backlog = max(queued, self._active - self.max_active if self.max_active else 0) + count
+        return max(1, min(600, math.ceil(backlog / rate)))
+
+    def stats(self):
+        with self._lock:
+            submitted, coalesced, rejected = self.submitted, self.coalesced, self.rejected
+            active, drain_rate = self._active, self.drain_rate()
+        return {
+            'submitted': submitted,
+            'coalesced': coalesced,
+            'rejected': rejected,
+            'active': active,
+            'drain_rate_per_min': round(drain_rate * 60, 2),
+            'queued': len(self.resolve_pool),
+            'resolving': self.resolve_pool.active,
+            'awaiting_download': len(self.download_pool),
+            'downloading': self.download_pool.active,
+            'awaiting_transcode': len(self.transcode_pool),
+            'transcoding': self.transcode_pool.active,
+            'memory': self.transcode_pool.stats(),
+        }
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def get_batch(self, batch_id):
+        with self._lock:
+            return self._batches.get(batch_id)
+
+    def _prune(self):
+        cutoff = time.time() - app.config['JOB_RETENTION']
+        for job_id in [j.id for j in self._jobs.values() if j.is_finished and j.finished_at < cutoff]:
+            del self._jobs[job_id]
+        for batch_id in [b.id for b in self._batches.values()
+                         if b.is_finished and b.finished_at < cutoff]:
+            del self._batches[batch_id]
+
+    def _release(self, job):
+        with self._lock:
+            self._active -= 1
+            self._completions.append(time.time())
+            if job.key and self._inflight.get(job.key) is job:
+                del self._inflight[job.key]
+
+    def _stage(self, handler, next_pool=None, waiting_stage=None, first=False):
+        """Wrap a stage handler so the job moves on to next_pool or is released."""
+        def run(job):
+            if first:
+                job.start()
+            try:
+                proceed = handler(job)
+            except BaseException:
+                self._release(job)
+                raise
+            if proceed and next_pool is not None:
+                job.update_progress(stage=waiting_stage)
+                # Blocks while next_pool's queue is full
+                next_pool.put(job)
+            else:
+                self._release(job)
+        return run
+
 def setup_logging():
     """Configure basic logging to console."""
     # Clear any existing handlers
@@ -122,108 +1888,785 @@ def log_error(message, error=None, exc_info=False):
     else:
         logger.error(message)
 
+class SourceDownload:
+    """A downloaded source waiting for its transcode, plus its scratch directory.
+
+    For clip jobs, clip is the requested (start, end) and seek the offset
+    into source_path where the clip starts (None if the file starts there).
+    """
+
+    def __init__(self, info, video_id, source_path, output_path, scratch_dir):
+        self.info = info
+        self.video_id = video_id
+        self.source_path = source_path
+        self.output_path = output_path
+        self.scratch_dir = scratch_dir
+        self.clip = None
+        self.seek = None
+
+    def cleanup(self):
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
+def lookup_cached_output(url, clip=None, count_miss=True):
+    """Cached result for url found without any network access, or None.
+
+    That works for recognisable YouTube URLs and for any URL whose video id
+    the metadata cache recorded from an earlier extraction.
+    """
+    video_id = extract_video_id(url) or (metadata_cache.get(url, count_miss) or {}).get('id')
+    if not video_id:
+        return None
+    cached = output_cache.lookup(cache_key(video_id, clip), count_miss)
+    if not cached:
+        return None
+    logger.info(f"Cache hit for {video_id}: {cached['filename']}")
+    return dict(cached, cached=True)
+
+def resolve_video(url, progress=None, clip=None):
+    """Resolve stage: check the output cache, then extract the video once.
+
+    Returns (cached_result, None) on a cache hit, otherwise (None, info)
+    where info is the full yt-dlp info dict. fetch_source() downloads from
+    that same dict, so the video is never extracted a second time.
+    """
+    progress = progress or (lambda **fields: None)
+    logger.info(f"Processing URL: {url}")
+
+    cached = lookup_cached_output(url, clip)
+    if cached:
+        return cached, None
+
+    progress(stage='resolving')
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+    metadata_cache.put(url, info)
+
+    if info.get('id') and info['id'] != extract_video_id(url):
+        cached = output_cache.lookup(cache_key(info['id'], clip))
+        if cached:
+            logger.info(f"Cache hit for {info['id']}: {cached['filename']}")
+            return dict(cached, cached=True), None
+
+    return None, info
+
+def estimate_job_cost(info):
+    """Scheduling cost of a job: the duration of its audio in seconds."""
+    return info.get('duration') or UNKNOWN_DURATION_COST
+
+def clip_info(info, clip):
+    """info as seen by cost estimates for a clip job: duration is the clip length."""
+    return dict(info, duration=clip_duration(clip, info.get('duration'))) if clip else info
+
+def estimate_job_memory(info):
+    """Estimated peak memory of a transcode in bytes.
+
+    Modelled as linear in duration x sample rate x channels. The chunked
+    PCM engine keeps the per-second term small; JOB_MEMORY_FACTOR is the
+    fraction of the decoded PCM size a job is assumed to hold on top of
+    JOB_MEMORY_BASE.
+    """
+    duration = info.get('duration') or UNKNOWN_DURATION_COST
+    pcm_bytes = duration * SAMPLE_RATE * CHANNELS * SAMPLE_WIDTH
+    return int(app.config['JOB_MEMORY_BASE'] + pcm_bytes * app.config['JOB_MEMORY_FACTOR'])
+
+def fetch_source(url, info, progress=None, clip=None):
+    """Download stage: fetch the best audio stream described by info.
+
+    With a clip (start, end) only that section is fetched: yt-dlp's
+    download_ranges hands it to ffmpeg, which seeks the remote input and
+    copies just the packets in range. Returns a SourceDownload for
+    transcode_source().
+    """
+    progress = progress or (lambda **fields: None)
+
+    # Each job downloads into its own scratch directory so concurrent jobs never
+    # see each other's files
+    scratch_dir = tempfile.mkdtemp(prefix='job_', dir=process_scratch_dir())
+
+    # Configure yt-dlp to fetch the best quality audio stream
+    download_opts = ydl_opts.copy()
+    download_opts['outtmpl'] = os.path.join(scratch_dir, 'source.%(ext)s')
+    download_opts['progress_hooks'] = [lambda d: report_download_progress(d, progress)]
+    download_opts['postprocessor_hooks'] = [
+        lambda d: progress(stage='postprocessing', postprocessor=d.get('postprocessor'))]
+    if clip:
+        download_opts['download_ranges'] = yt_dlp.utils.download_range_func(
+            None, [(clip[0], math.inf if clip[1] is None else clip[1])])
+        if os.path.dirname(FFMPEG_BINARY):
+            download_opts['ffmpeg_location'] = FFMPEG_BINARY
+
+    # The output path should point to the final WAV file
+    video_id = extract_video_id(url) or info.get('id', str(int(time.time())))
+    output_path = os.path.join(TEMP_AUDIO_DIR, build_output_filename(info, clip))
+
+    try:
+        logger.info("Downloading audio...")
+        progress(stage='downloading')
+        with yt_dlp.YoutubeDL(download_opts) as ydl:
+            # Download from the info dict we already have instead of re-extracting
+            downloaded = ydl.process_ie_result(info, download=True)
+
+        # The produced path is reported by yt-dlp itself
+        requested = (downloaded or {}).get('requested_downloads') or [{}]
+        temp_audio_file = requested[-1].get('filepath')
+        if not temp_audio_file or not os.path.isfile(temp_audio_file):
+            raise ConversionError('Download was unsuccessful. No temporary audio file found.')
+    except BaseException:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        raise
+
+    source = SourceDownload(clip_info(info, clip), video_id, temp_audio_file, output_path, scratch_dir)
+    if clip:
+        source.clip = clip
+        # A section download starts at the clip; anything else still has to be seeked
+        if requested[-1].get('section_start') is None:
+            source.seek = clip[0]
+    return source
+
+def transcode_source(source, progress=None):
+    """CPU stage: decode a downloaded source into the final WAV and cache it."""
+    progress = progress or (lambda **fields: None)
+    info = source.info
+    try:
+        # Decode the downloaded stream straight into the final WAV
+        logger.info(f"Converting '{source.source_path}' to WAV...")
+        progress(stage='converting', transcode_percent=0.0)
+        master = master_filename(os.path.basename(source.output_path))
+        scratch_output = os.path.join(source.scratch_dir, 'output' + os.path.splitext(master)[1])
+        limit = info.get('duration') if source.clip else None
+        writer = transcode_to_wav(source.source_path, scratch_output, info.get('duration'), progress,
+                                  start=source.seek, limit=limit)
+        os.replace(scratch_output, os.path.join(os.path.dirname(source.output_path), master))
+    finally:
+        # Remove the downloaded source and anything else left in scratch
+        source.cleanup()
+
+    # Get final file stats
+    result = build_result(info, source.output_path, writer.data_size)
+    output_cache.store(cache_key(source.video_id, source.clip), result, writer, master=master)
+    duration = int(result['duration'])
+
+    logger.info(f"Successfully converted and saved: {result['filename']} "
+                f"({result['size_mb']:.2f}MB, {duration//60}:{duration%60:02d})")
+
+    return dict(result, cached=False)
+
+def convert_video(url, progress=None, clip=None):
+    """Resolve, download and convert a video inline, returning the result payload."""
+    cached, info = resolve_video(url, progress, clip)
+    if cached:
+        return cached
+    return transcode_source(fetch_source(url, info, progress, clip), progress)
+
+def report_download_progress(d, progress):
+    """Forward a yt-dlp progress hook event to a progress callback."""
+    if d.get('status') == 'downloading':
+        progress(
+            stage='downloading',
+            downloaded_bytes=d.get('downloaded_bytes'),
+            total_bytes=d.get('total_bytes') or d.get('total_bytes_estimate'),
+            speed=d.get('speed'),
+            eta=d.get('eta'))
+    elif d.get('status') == 'finished':
+        progress(stage='downloaded', downloaded_bytes=d.get('downloaded_bytes') or d.get('total_bytes'), eta=0)
+
+def record_job_failure(job, e):
+    """Log an exception raised by a job stage and mark the job failed."""
+    if isinstance(e, yt_dlp.utils.DownloadError):
+        logger.error(f"Download error: {str(e)}", exc_info=True)
+        job.fail(*describe_download_error(e))
+    elif isinstance(e, ConversionError):
+        logger.error(f"Conversion failed: {str(e)}")
+        job.fail(str(e), 500)
+    else:
+        logger.error(f"Unexpected error in job {job.id}: {str(e)}", exc_info=True)
+        job.fail('An unexpected error occurred. Please try again later.', 500)
+
+def run_resolve_stage(job):
+    """Resolve worker entry point. Returns True if the job still needs a download."""
+    try:
+        cached, info = resolve_video(job.url, progress=job.update_progress, clip=job.clip)
+    except Exception as e:
+        record_job_failure(job, e)
+        return False
+    if cached:
+        job.finish(cached)
+        return False
+    if job.clip and clip_duration(job.clip, info.get('duration')) == 0:
+        job.fail('The requested start is past the end of the video', 400)
+        return False
+    job.info = info
+    job.cost = estimate_job_cost(clip_info(info, job.clip))
+    job.memory = estimate_job_memory(clip_info(info, job.clip))
+    job.host = urlparse(info.get('webpage_url') or job.url).netloc.lower()
+    return True
+
+def run_expand_stage(batch):
+    """Resolve worker entry point for a collection batch: (title, [(url, key)]) or None if it failed."""
+    try:
+        title, entry_urls = expand_collection(batch.url, max_batch_size())
+    except Exception as e:
+        record_job_failure(batch, e)
+        return None
+    if not entry_urls:
+        batch.fail('This playlist has no downloadable videos', 404)
+        return None
+    return title, [(u, job_key(u)) for u in entry_urls]
+
+def run_download_stage(job):
+    """Download worker entry point. Returns True if the job still needs a transcode."""
+    try:
+        job.source = fetch_source(job.url, job.info, progress=job.update_progress, clip=job.clip)
+    except Exception as e:
+        record_job_failure(job, e)
+        return False
+    finally:
+        job.info = None
+    return True
+
+def run_transcode_stage(job):
+    """Transcode worker entry point: finish the job from its downloaded source."""
+    try:
+        job.finish(transcode_source(job.source, progress=job.update_progress))
+    except Exception as e:
+        record_job_failure(job, e)
+    finally:
+        job.source = None
+
+output_cache = OutputCache(TEMP_AUDIO_DIR)
+metadata_cache = MetadataCache(
+    max_entries=app.config['METADATA_CACHE_SIZE'],
+    ttl=app.config['METADATA_TTL'],
+    db_path=app.config['METADATA_DB'])
+job_queue = JobQueue(
+    run_resolve_stage, run_download_stage, run_transcode_stage,
+    resolve_workers=app.config['RESOLVE_WORKERS'],
+    download_workers=app.config['DOWNLOAD_WORKERS'],
+    transcode_workers=app.config['TRANSCODE_WORKERS'],
+    transcode_queue_size=app.config['TRANSCODE_QUEUE_SIZE'],
+    fast_lane_workers=app.config['FAST_LANE_WORKERS'],
+    short_job_seconds=app.config['SHORT_JOB_SECONDS'],
+    aging_rate=app.config['SJF_AGING_RATE'],
+    per_host_limit=app.config['MAX_DOWNLOADS_PER_HOST'],
+    memory_budget=app.config['MEMORY_BUDGET'],
+    max_active=app.config['MAX_ACTIVE_JOBS'],
+    max_queued=app.config['MAX_QUEUE_DEPTH'],
+    expand_handler=run_expand_stage)
+
+_background_started = False
+_background_lock = threading.Lock()
+
+@app.before_request
+def start_background_threads():
+    """Start the cache janitor and job workers on the first request.
+
+    Deferring them to a process that actually serves requests keeps them
+    out of the debug reloader's parent process, whose OutputCache would
+    otherwise evict files and rewrite cache_index.json behind the server's.
+    Scratch directories of processes that have exited are cleared here too,
+    never at import.
+    """
+    global _background_started
+    if _background_started:
+        return
+    with _background_lock:
+        if _background_started:
+            return
+        remove_orphaned_scratch()
+        threading.Thread(target=run_janitor, name='cache-janitor', daemon=True).start()
+        job_queue.start()
+        _background_started = True
+
+def max_batch_size():
+    """Most URLs one batch or playlist may hold: MAX_BATCH_SIZE, capped so it can be admitted."""
+    limit = job_queue.max_batch_size
+    return min(app.config['MAX_BATCH_SIZE'], limit) if limit else app.config['MAX_BATCH_SIZE']
+
+def job_key(url, clip=None):
+    """Single-flight key for a submitted URL (and clip range)."""
+    video_id = extract_video_id(url)
+    if video_id:
+        return cache_key(video_id, clip)
+    return f"{url}|{format_clip(clip)}" if clip else url
+
+def queue_full_response(e):
+    """429 response telling the client when to retry after a QueueFullError."""
+    response = jsonify({'error': 'The server is busy. Please try again shortly.',
+                        'retry_after': e.retry_after})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 429
+
 @app.route('/download', methods=['POST'])
 def download_audio():
-    """Handle audio download and conversion with highest quality settings."""
+    """Queue an audio download and conversion job and return its id.
+
+    Playlist and channel URLs return a batch id at once; a resolve worker
+    then expands them into one job per entry.
+    Optional start/end (seconds) convert only that section of a single video.
+    """
     try:
         data = request.get_json()
         if not data or 'url' not in data:
             return jsonify({'error': 'No URL provided'}), 400
 
         url = data['url'].strip()
-        logger.info(f"Processing URL: {url}")
-        
-        # Get video info to create a clean filename
-        with yt_dlp.YoutubeDL({'quiet': True, 'extract_flat': True}) as ydl:
-            info = ydl.extract_info(url, download=False)
-        
-        # Create a clean filename
-        title = re.sub(r'[^\w\s-]', '', info.get('title', 'audio')).strip()
-        uploader = re.sub(r'[^\w\s-]', '', info.get('uploader', 'unknown')).strip()
-        video_id = info.get('id', str(int(time.time())))
-        
-        # The output path should point to the final WAV file
-        output_path = os.path.join(TEMP_AUDIO_DIR, f"{title} - {uploader} - {video_id}.wav")
-        
-        # Use a temporary file for the initial download to prevent overwrites
-        temp_outtmpl = os.path.join(TEMP_AUDIO_DIR, 'temp_audio_%(id)s.%(ext)s')
-        
-        # Configure yt-dlp for best quality audio extraction and conversion
-        download_opts = ydl_opts.copy()
-        download_opts['outtmpl'] = temp_outtmpl
-        
-        logger.info("Downloading and converting audio...")
-        
-        with yt_dlp.YoutubeDL(download_opts) as ydl:
-            ydl.download([url])
-        
-        # Find the downloaded file
-        downloaded_files = os.listdir(TEMP_AUDIO_DIR)
-        temp_audio_file = None
-        for f in downloaded_files:
-            if f.startswith(f"temp_audio_{video_id}"):
-                temp_audio_file = os.path.join(TEMP_AUDIO_DIR, f)
-                break
-        
-        if not temp_audio_file:
-            return jsonify({'error': 'Download was unsuccessful. No temporary audio file found.'}), 500
-
-        # Now convert the downloaded file to WAV using pydub
-        logger.info(f"Converting '{temp_audio_file}' to WAV...")
-        audio = AudioSegment.from_file(temp_audio_file)
-        audio.export(output_path, 
-                     format="wav", 
-                     parameters=["-acodec", "pcm_s16le", "-ar", "48000", "-ac", "2", "-b:a", "320k"])
-        
-        # Remove the temporary file
-        os.remove(temp_audio_file)
-        
-        # Get final file stats
-        file_size = os.path.getsize(output_path) / (1024 * 1024)  # in MB
-        duration = info.get('duration', 0)
-        
-        logger.info(f"Successfully converted and saved: {os.path.basename(output_path)} "
-                  f"({file_size:.2f}MB, {duration//60}:{duration%60:02d})")
-        
-        return jsonify({
-            'filename': os.path.basename(output_path),
-            'title': info.get('title', 'audio'),
-            'uploader': info.get('uploader', 'unknown'),
-            'duration': duration,
-            'size_mb': round(file_size, 2)
-        })
-        
+        try:
+            clip = parse_clip(data)
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': f'Invalid start/end: {e}'}), 400
+
+        if is_collection_url(url):
+            if clip:
+                return jsonify({'error': 'start/end cannot be used with playlists or channels'}), 400
+            try:
+                batch = job_queue.submit_collection(url)
+            except QueueFullError as e:
+                logger.warning(f"Rejected playlist {url}: {str(e)}")
+                return queue_full_response(e)
+            return jsonify({'batch_id': batch.id, 'status': 'expanding'}), 202
+
+        # A cache hit is answered right away, even when the queue is full
+        cached = lookup_cached_output(url, clip, count_miss=False)
+        if cached:
+            job = job_queue.record_hit(url, cached, clip=clip)
+            return jsonify({'job_id': job.id, 'status': job.status, 'result': job.result}), 200
+
+        try:
+            job = job_queue.submit(url, key=job_key(url, clip), clip=clip)
+        except QueueFullError as e:
+            logger.warning(f"Rejected {url}: {str(e)}")
+            return queue_full_response(e)
+        return jsonify({'job_id': job.id, 'status': job.status}), 202
+
     except yt_dlp.utils.DownloadError as e:
-        error_msg = f"Download error: {str(e)}"
-        logger.error(error_msg, exc_info=True)
-        if 'Private video' in str(e):
-            return jsonify({'error': 'This video is private and cannot be downloaded'}), 403
-        elif 'Video unavailable' in str(e):
-            return jsonify({'error': 'This video is unavailable or restricted'}), 404
-        elif 'Unsupported URL' in str(e):
-            return jsonify({'error': 'Unsupported URL. Please provide a valid YouTube URL'}), 400
-        else:
-            return jsonify({'error': 'Error downloading video. Please try again later.'}), 500
-            
+        logger.error(f"Download error: {str(e)}", exc_info=True)
+        return download_error_response(e)
+
     except Exception as e:
         error_msg = f"Unexpected error in download_audio: {str(e)}"
         logger.error(error_msg, exc_info=True)
         return jsonify({'error': 'An unexpected error occurred. Please try again later.'}), 500
 
+@app.route('/download/batch', methods=['POST'])
+def download_batch():
+    """Queue one conversion job per URL and return the batch and job ids."""
+    try:
+        data = request.get_json()
+        urls = data.get('urls') if isinstance(data, dict) else None
+        if not urls or not isinstance(urls, list):
+            return jsonify({'error': 'No URLs provided'}), 400
+        if len(urls) > max_batch_size():
+            return jsonify({'error': f"A batch can contain at most {max_batch_size()} URLs"}), 400
+
+        entries = [(str(url).strip(), job_key(str(url).strip())) for url in urls]
+        # A playlist inside a batch would become one job trying to download every entry
+        collections = [url for url, _ in entries if is_collection_url(url)]
+        if collections:
+            return jsonify({'error': 'Playlists and channels cannot be part of a batch; submit them on their own',
+                            'urls': collections}), 400
+
+        try:
+            batch = job_queue.submit_batch(entries)
+        except QueueFullError as e:
+            logger.warning(f"Rejected batch of {len(entries)} URL(s): {str(e)}")
+            return queue_full_response(e)
+        return jsonify({'batch_id': batch.id, 'job_ids': [j.id for j in batch.jobs]}), 202
+
+    except Exception as e:
+        error_msg = f"Unexpected error in download_batch: {str(e)}"
+        logger.error(error_msg, exc_info=True)
+        return jsonify({'error': 'An unexpected error occurred. Please try again later.'}), 500
+
+@app.route('/batches/<batch_id>')
+def batch_status(batch_id):
+    """Report aggregate progress of a batch and the state of each job in it."""
+    batch = job_queue.get_batch(batch_id)
+    if not batch:
+        return jsonify({'error': 'Batch not found'}), 404
+    return jsonify(batch.to_dict())
+
+@app.route('/batches/<batch_id>/events')
+def batch_events(batch_id):
+    """Server-Sent Events stream of a batch's aggregate progress until every job finishes."""
+    batch = job_queue.get_batch(batch_id)
+    if not batch:
+        return jsonify({'error': 'Batch not found'}), 404
+
+    def events():
+        version = -1
+        idle = 0.0
+        while True:
+            current = batch.version
+            if current != version:
+                version = current
+                idle = 0.0
+                yield f"data: {json.dumps(batch.to_dict())}\n\n"
+                if batch.is_finished:
+                    return
+            elif idle >= 15:
+                idle = 0.0
+                yield ': keepalive\n\n'
+            time.sleep(SSE_MIN_INTERVAL)
+            idle += SSE_MIN_INTERVAL
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/download/batch/<batch_id>.zip')
+def download_batch_zip(batch_id):
+    """Stream the finished WAVs of a batch as one uncompressed ZIP, built on the fly."""
+    batch = job_queue.get_batch(batch_id)
+    if not batch:
+        return jsonify({'error': 'Batch not found'}), 404
+
+    filenames = []
+    for job in batch.jobs:
+        if job.status == 'done' and job.result['filename'] not in filenames:
+            filenames.append(job.result['filename'])
+
+    # Pin every member up front so none can be evicted while the archive is sent
+    members = []
+    pinned = []
+    for filename in filenames:
+        output_cache.pin(filename)
+        entry = output_cache.file_entry(filename)
+        path = output_cache.master_path(entry) if entry else os.path.join(TEMP_AUDIO_DIR, filename)
+        if not os.path.isfile(path):
+            output_cache.unpin(filename)
+            continue
+        pinned.append(filename)
+        stat = os.stat(path)
+        if entry and 'master' in entry:
+            # FLAC master: the member is the WAV rebuilt from it
+            size = len(wav_header()) + entry['data_size']
+            crc = entry['crc32']
+        else:
+            size = stat.st_size
+            crc = entry.get('crc32') if entry and entry.get('size') == size else None
+        members.append((make_safe_filename(filename), size, stat.st_mtime, crc,
+                        iter_wav(path, entry.get('data_size') if entry else None)))
+    if not members:
+        return jsonify({'error': 'No finished files in this batch'}), 404
+
+    def generate():
+        try:
+            yield from guard_body(stream_zip(members), 'Streaming ZIP failed')
+        finally:
+            for filename in pinned:
+                output_cache.unpin(filename)
+
+    return Response(generate(), mimetype='application/zip',
+                    headers={
+                        'Content-Disposition': f'attachment; filename="batch-{batch_id[:8]}.zip"',
+                        'X-Accel-Buffering': 'no',
+                    })
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Report the state of a queued conversion job."""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Server-Sent Events stream of a job's progress until it finishes."""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+
+    def events():
+        version = -1
+        while True:
+            current = job.wait_for_change(version, timeout=15)
+            if current == version:
+                # Keep proxies from closing an idle connection
+                yield ': keepalive\n\n'
+                continue
+            version = current
+            yield f"data: {json.dumps(job.to_dict())}\n\n"
+            if job.is_finished:
+                return
+            # Coalesce bursts of yt-dlp hook calls into a few events per second
+            time.sleep(SSE_MIN_INTERVAL)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/stream')
+def stream_audio():
+    """Stream the WAV to the client while it is being decoded."""
+    try:
+        url = request.args.get('url', '').strip()
+        if not url:
+            return jsonify({'error': 'No URL provided'}), 400
+
+        logger.info(f"Streaming URL: {url}")
+
+        video_id = extract_video_id(url)
+        if video_id:
+            cached = output_cache.lookup(cache_key(video_id))
+            if cached:
+                return redirect(f"/download/{cached['filename']}")
+
+        # Resolve the direct media URL so ffmpeg can decode while downloading
+        stream_opts = ydl_opts.copy()
+        stream_opts['format'] = 'bestaudio[protocol^=http]/bestaudio/best'
+        with yt_dlp.YoutubeDL(stream_opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+
+        filename = build_output_filename(info)
+        output_path = os.path.join(TEMP_AUDIO_DIR, filename)
+
+        media_url = info.get('url')
+        if not media_url:
+            return jsonify({'error': 'No streamable audio format found'}), 502
+
+        cache_path = os.path.join(TEMP_AUDIO_DIR, master_filename(filename)) if app.config['STREAM_CACHE'] else None
+        key = cache_key(info['id'])
+        return Response(
+            stream_wav(media_url, info.get('http_headers'), cache_path,
+                       on_cached=lambda writer: output_cache.store(
+                           key, build_result(info, output_path, writer.data_size), writer)),
+            mimetype='audio/wav',
+            headers={
+                'Content-Disposition': f'attachment; filename="{make_safe_filename(filename)}"',
+                'X-Accel-Buffering': 'no',
+            })
+
+    except yt_dlp.utils.DownloadError as e:
+        logger.error(f"Download error: {str(e)}", exc_info=True)
+        return download_error_response(e)
+
+    except Exception as e:
+        logger.error(f"Unexpected error in stream_audio: {str(e)}", exc_info=True)
+        return jsonify({'error': 'An unexpected error occurred. Please try again later.'}), 500
+
+@app.route('/stats')
+def service_stats():
+    """Expose cache and queue counters."""
+    return jsonify({
+        'cache': output_cache.stats(),
+        'metadata': metadata_cache.stats(),
+        'jobs': job_queue.stats(),
+    })
+
+def set_immutable_cache_headers(response):
+    """Let browsers and CDNs keep a finished output without revalidating."""
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['DOWNLOAD_MAX_AGE']
+    response.cache_control.immutable = True
+
+def offloaded_file_response(filename, path, entry=None):
+    """Empty response telling the front-end server to send the file itself.
+
+    path must already be safe_join()ed under TEMP_AUDIO_DIR.
+
+    The worker returns immediately. The file is not pinned for the transfer,
+    but touching it makes it the most recently used entry, and on POSIX an
+    eviction after the server has opened it does not interrupt the download.
+    """
+    output_cache.touch(filename)
+    response = Response(mimetype='audio/wav')
+    if app.config['SENDFILE_MODE'] == 'x-accel':
+        response.headers['X-Accel-Redirect'] = app.config['SENDFILE_PREFIX'] + quote(filename)
+    else:
+        response.headers['X-Sendfile'] = path
+    response.headers['Content-Disposition'] = f'attachment; filename="{make_safe_filename(filename)}"'
+    if entry:
+        response.set_etag(entry['sha256'])
+        response.last_modified = entry['created_at']
+        set_immutable_cache_headers(response)
+        response.make_conditional(request)
+    return response
+
+def requested_range(total, etag, last_modified):
+    """(start, stop) of a single satisfiable Range request, None to send everything, or 'invalid'.
+
+    Multi-range requests and stale If-Range validators get the full body.
+    """
+    if not request.range or request.range.units != 'bytes' or len(request.range.ranges) != 1:
+        return None
+    if_range = request.if_range
+    if if_range.etag and if_range.etag != etag:
+        return None
+    if if_range.date and if_range.date.timestamp() < int(last_modified):
+        return None
+    return request.range.range_for_length(total) or 'invalid'
+
+def master_wav_response(filename, entry):
+    """Stream the WAV for a FLAC-backed entry, decoding the master on the fly.
+
+    The header comes from the recorded sample count, so the bytes, length
+    and ETag are identical to those of the WAV the master was made from.
+    Range requests decode only from the nearest seek point before the range.
+    """
+    path = output_cache.master_path(entry)
+    if not os.path.isfile(path):
+        return "File not found", 404
+
+    total = len(wav_header()) + entry['data_size']
+    byte_range = requested_range(total, entry.get('sha256'), entry['created_at'])
+    if byte_range == 'invalid':
+        response = Response(status=416)
+        response.headers['Content-Range'] = f'bytes */{total}'
+        return response
+    seek_index = load_seek_index(path) if byte_range else None
+
+    if byte_range:
+        body = iter_wav_range(path, entry['data_size'], seek_index, *byte_range)
+    else:
+        body = iter_wav(path, entry['data_size'])
+
+    output_cache.pin(filename)
+    response = Response(guard_body(body, 'Decoding cached master failed'), mimetype='audio/wav')
+    response.call_on_close(lambda: output_cache.unpin(filename))
+    response.headers['Content-Disposition'] = f'attachment; filename="{make_safe_filename(filename)}"'
+    response.accept_ranges = 'bytes'
+    if entry.get('sha256'):
+        response.set_etag(entry['sha256'])
+        response.last_modified = entry['created_at']
+        set_immutable_cache_headers(response)
+    if byte_range:
+        response.status_code = 206
+        response.content_range = ContentRange('bytes', byte_range[0], byte_range[1], total)
+        response.content_length = byte_range[1] - byte_range[0]
+    else:
+        response.content_length = total
+        response.make_conditional(request)
+    return response
+
+def parse_clip_bounds(args, total_samples):
+    """(start, end) sample numbers from start/end query arguments.
+
+    start and end are seconds unless unit=samples; end defaults to the end
+    of the track. Raises ValueError for bounds outside the track.
+    """
+    scale = 1 if args.get('unit') == 'samples' else SAMPLE_RATE
+    start = round(float(args.get('start', 0)) * scale)
+    end = round(float(args['end']) * scale) if 'end' in args else total_samples
+    end = min(end, total_samples)
+    if not 0 <= start < end:
+        raise ValueError('start must be before end and inside the track')
+    return start, end
+
+@app.route('/clip/<path:filename>')
+def clip_file(filename):
+    """Serve a sample-accurate section of a cached WAV behind its own header.
+
+    WAV masters are read from the clip's offset in bounded chunks; FLAC
+    masters decode only from the seek point before the clip.
+    """
+    try:
+        entry = output_cache.file_entry(filename)
+        path = output_cache.master_path(entry) if entry else None
+        if not path or not os.path.isfile(path):
+            return jsonify({'error': 'File not found'}), 404
+
+        header_size = len(wav_header())
+        frame_bytes = CHANNELS * SAMPLE_WIDTH
+        data_size = entry.get('data_size', os.path.getsize(path) - header_size)
+        try:
+            start, end = parse_clip_bounds(request.args, data_size // frame_bytes)
+        except (ValueError, OverflowError) as e:
+            return jsonify({'error': f'Invalid clip bounds: {e}'}), 400
+
+        clip_size = (end - start) * frame_bytes
+        first = header_size + start * frame_bytes
+        etag = f"{entry['sha256']}-{start}-{end}" if entry.get('sha256') else None
+        if etag and etag in request.if_none_match:
+            response = Response(status=304)
+            response.set_etag(etag)
+            set_immutable_cache_headers(response)
+            return response
+
+        closers = [lambda: output_cache.unpin(filename)]
+        if 'master' in entry:
+            body = iter_wav_range(path, data_size, load_seek_index(path), first, first + clip_size)
+        else:
+            f = open(path, 'rb')
+            f.seek(36)
+            if f.read(4) != b'data':
+                f.close()
+                return jsonify({'error': 'Cached file has an unexpected WAV layout'}), 500
+            closers.append(f.close)
+            f.seek(first)
+            body = (f.read(min(ZIP_CHUNK_SIZE, first + clip_size - offset))
+                    for offset in range(first, first + clip_size, ZIP_CHUNK_SIZE))
+
+        def generate():
+            yield wav_header(clip_size)
+            yield from guard_body(body, 'Serving clip failed')
+
+        def close():
+            for closer in closers:
+                closer()
+
+        output_cache.pin(filename)
+        response = Response(generate(), mimetype='audio/wav')
+        response.call_on_close(close)
+        clip_name = f"{os.path.splitext(filename)[0]}_{start}-{end}.wav"
+        response.headers['Content-Disposition'] = f'attachment; filename="{make_safe_filename(clip_name)}"'
+        response.content_length = header_size + clip_size
+        if etag:
+            response.set_etag(etag)
+            set_immutable_cache_headers(response)
+        return response
+    except Exception as e:
+        log_error('Error serving clip', e)
+        return jsonify({'error': 'Error serving clip'}), 500
+
 @app.route('/download/<path:filename>')
 def download_file(filename):
     """Serve the downloaded file for download."""
     try:
+        # Only finished outputs are served; the index, FLAC masters, seek
+        # sidecars and scratch files share the directory but are not in it
+        entry = output_cache.file_entry(filename)
+        if not entry:
+            return "File not found", 404
+
+        # Files with a recorded content digest get a strong ETag and can be cached for good
+        etag = entry.get('sha256')
+        if etag and etag in request.if_none_match:
+            response = Response(status=304)
+            response.set_etag(etag)
+            set_immutable_cache_headers(response)
+            return response
+
+        if 'master' in entry:
+            return master_wav_response(filename, entry)
+
         # Ensure the filename is safe
-        if not os.path.isfile(os.path.join(TEMP_AUDIO_DIR, filename)):
+        path = safe_join(TEMP_AUDIO_DIR, filename)
+        if not path or not os.path.isfile(path):
             return "File not found", 404
             
-        return send_from_directory(
-            TEMP_AUDIO_DIR,
-            filename,
-            as_attachment=True,
-            download_name=make_safe_filename(filename)
-        )
+        if app.config['SENDFILE_MODE']:
+            return offloaded_file_response(filename, path, entry if etag else None)
+
+        # Pin the file until the response has been sent so it cannot be evicted mid-transfer
+        output_cache.pin(filename)
+        try:
+            response = send_from_directory(
+                TEMP_AUDIO_DIR,
+                filename,
+                as_attachment=True,
+                download_name=make_safe_filename(filename),
+                etag=etag or True,
+                last_modified=entry['created_at'] if etag else None,
+                max_age=app.config['DOWNLOAD_MAX_AGE'] if etag else None,
+            )
+        except Exception:
+            output_cache.unpin(filename)
+            raise
+        if etag:
+            set_immutable_cache_headers(response)
+        # Werkzeug skips close callbacks for passthrough bodies, which would leave the file pinned
+        response.direct_passthrough = False
+        response.call_on_close(lambda: output_cache.unpin(filename))
+        return response
     except Exception as e:
         log_error('Error serving file', e)
         return "Error serving file", 500
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Download benchmark - serving WAVs from Python vs. X-Accel-Redirect offload.
+
+The app runs behind a small front-end proxy standing in for nginx. The app
+gets a fixed pool of worker threads, as under gunicorn. The proxy forwards
+each request to the app. When the app answers with X-Accel-Redirect, the
+proxy sends the file itself with os.sendfile(); otherwise it relays the
+body the app streams.
+
+Each client reads at a capped rate to emulate real links. While the
+downloads run, a probe measures how long the app takes to answer
+GET /stats. That is how long a conversion request would wait for a free
+worker.
+
+Usage:
+    python benchmarks/bench_download.py                       # 64 MB file, 16 clients, 4 workers
+    python benchmarks/bench_download.py --clients 32 --size-mb 256 --rate-mb 16
+"""
+import os
+import sys
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import statistics
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from socketserver import TCPServer
+from urllib.parse import unquote
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Keep the test file and its cache index away from a real temp_audio
+BENCH_DIR = tempfile.mkdtemp(prefix='bench_download_')
+os.environ['TEMP_AUDIO_DIR'] = BENCH_DIR
+
+import app as audio_app
+
+ACCEL_PREFIX = '/protected-audio/'
+
+
+class PooledWSGIServer(WSGIServer):
+    """WSGI server that handles requests on a fixed number of threads."""
+
+    workers = 4
+
+    def server_activate(self):
+        super().server_activate()
+        self._pool = ThreadPoolExecutor(self.workers)
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class FrontProxy(BaseHTTPRequestHandler):
+    """Minimal nginx stand-in: proxies to the app and honours X-Accel-Redirect."""
+
+    protocol_version = 'HTTP/1.1'
+    upstream = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        conn = http.client.HTTPConnection(*self.upstream)
+        conn.request('GET', self.path)
+        upstream = conn.getresponse()
+        accel = upstream.getheader('X-Accel-Redirect')
+        if accel:
+            upstream.read()
+            conn.close()
+            self._send_file(os.path.join(audio_app.TEMP_AUDIO_DIR, unquote(accel[len(ACCEL_PREFIX):])))
+            return
+
+        self.send_response(upstream.status)
+        for name, value in upstream.getheaders():
+            if name.lower() not in ('connection', 'transfer-encoding'):
+                self.send_header(name, value)
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        while True:
+            chunk = upstream.read(64 * 1024)
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+        conn.close()
+        self.close_connection = True
+
+    def _send_file(self, path):
+        size = os.path.getsize(path)
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/wav')
+        self.send_header('Content-Length', str(size))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.flush()
+        with open(path, 'rb') as f:
+            offset = 0
+            while offset < size:
+                offset += os.sendfile(self.connection.fileno(), f.fileno(), offset, size - offset)
+        self.close_connection = True
+
+
+def start_servers(workers):
+    PooledWSGIServer.workers = workers
+    upstream = make_server('127.0.0.1', 0, audio_app.app, server_class=PooledWSGIServer, handler_class=QuietHandler)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    FrontProxy.upstream = ('127.0.0.1', upstream.server_port)
+    ThreadingHTTPServer.daemon_threads = True
+    TCPServer.request_queue_size = 256
+    front = ThreadingHTTPServer(('127.0.0.1', 0), FrontProxy)
+    threading.Thread(target=front.serve_forever, daemon=True).start()
+    return upstream, front
+
+
+def download(port, path, rate):
+    """Fetch path through the proxy, reading at most rate bytes per second."""
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(f'GET {path} HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n'.encode())
+    start = time.perf_counter()
+    received = 0
+    while True:
+        chunk = sock.recv(256 * 1024)
+        if not chunk:
+            break
+        received += len(chunk)
+        ahead = received / rate - (time.perf_counter() - start)
+        if ahead > 0:
+            time.sleep(ahead)
+    sock.close()
+    return time.perf_counter() - start, received
+
+
+def probe(port, stop, latencies):
+    """Time GET /stats until stop is set."""
+    while not stop.is_set():
+        start = time.perf_counter()
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+        conn.request('GET', '/stats')
+        conn.getresponse().read()
+        conn.close()
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.1)
+
+
+def run_mode(mode, port, path, clients, rate):
+    audio_app.app.config['SENDFILE_MODE'] = 'x-accel' if mode == 'x-accel' else ''
+    audio_app.app.config['SENDFILE_PREFIX'] = ACCEL_PREFIX
+    stop = threading.Event()
+    latencies = []
+    prober = threading.Thread(target=probe, args=(port, stop, latencies))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        futures = [pool.submit(download, port, path, rate) for _ in range(clients)]
+        prober.start()
+        results = [f.result() for f in futures]
+    wall = time.perf_counter() - start
+    stop.set()
+    prober.join()
+    total = sum(received for _, received in results)
+    return {
+        'wall_s': wall,
+        'throughput_mb_s': total / wall / (1024 * 1024),
+        'download_p50_s': statistics.median(t for t, _ in results),
+        'probe_p50_ms': statistics.median(latencies) * 1000,
+        'probe_max_ms': max(latencies) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=64, help='size of the served WAV')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent downloads')
+    parser.add_argument('--workers', type=int, default=4, help='app worker threads')
+    parser.add_argument('--rate-mb', type=float, default=32, help='per-client read rate in MB/s')
+    args = parser.parse_args()
+
+    filename = 'bench_download.wav'
+    path = os.path.join(audio_app.TEMP_AUDIO_DIR, filename)
+    try:
+        with open(path, 'wb') as f:
+            f.write(audio_app.wav_header(args.size_mb * 1024 * 1024))
+            block = os.urandom(1024 * 1024)
+            for _ in range(args.size_mb):
+                f.write(block)
+        # Only files in the output cache are served, so register this one
+        audio_app.output_cache.store('bench_download', {'filename': filename})
+
+        _, front = start_servers(args.workers)
+        results = {}
+        for mode in ('python', 'x-accel'):
+            results[mode] = run_mode(mode, front.server_port, f'/download/{filename}',
+                                     args.clients, args.rate_mb * 1024 * 1024)
+
+        print(f"{args.clients} clients x {args.size_mb} MB at {args.rate_mb:g} MB/s, {args.workers} app workers")
+        print(f"{'mode':<8} {'wall s':>7} {'MB/s':>7} {'dl p50 s':>9} {'/stats p50 ms':>14} {'/stats max ms':>14}")
+        for mode, r in results.items():
+            print(f"{mode:<8} {r['wall_s']:>7.2f} {r['throughput_mb_s']:>7.1f} {r['download_p50_s']:>9.2f} "
+                  f"{r['probe_p50_ms']:>14.1f} {r['probe_max_ms']:>14.1f}")
+    finally:
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Extraction benchmark - two yt-dlp resolutions per job vs. one.
+
+The old path ran a flat extract_info() for the title and then
+ydl.download([url]), which resolves the video again (webpage, player JS,
+signature deciphering). The new path extracts once and hands that info dict
+to process_ie_result(). Both runs use skip_download so only the extractor
+work is timed, which is exactly the per-job latency saved.
+
+Needs network access.
+
+Usage:
+    python benchmarks/bench_extract.py https://www.youtube.com/watch?v=... [--runs 5]
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+
+import yt_dlp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import ydl_opts
+
+
+def bench_opts():
+    opts = ydl_opts.copy()
+    opts.update({'quiet': True, 'no_warnings': True, 'skip_download': True})
+    return opts
+
+
+def run_two_extractions(url):
+    with yt_dlp.YoutubeDL({'quiet': True, 'extract_flat': True}) as ydl:
+        ydl.extract_info(url, download=False)
+    with yt_dlp.YoutubeDL(bench_opts()) as ydl:
+        ydl.download([url])
+
+
+def run_single_extraction(url):
+    with yt_dlp.YoutubeDL(bench_opts()) as ydl:
+        info = ydl.extract_info(url, download=False)
+        ydl.process_ie_result(info, download=True)
+
+
+MODES = {
+    'two-extractions': run_two_extractions,
+    'single-extraction': run_single_extraction,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('urls', nargs='+')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    timings = {mode: [] for mode in MODES}
+    for _ in range(args.runs):
+        # Interleave the modes so network jitter affects both equally
+        for mode, fn in MODES.items():
+            for url in args.urls:
+                start = time.perf_counter()
+                fn(url)
+                timings[mode].append(time.perf_counter() - start)
+
+    print(f"{'mode':<18} {'median s':>9} {'mean s':>8} {'min s':>7}")
+    for mode, t in timings.items():
+        print(f"{mode:<18} {statistics.median(t):>9.2f} {statistics.mean(t):>8.2f} {min(t):>7.2f}")
+    saved = statistics.median(timings['two-extractions']) - statistics.median(timings['single-extraction'])
+    print(f"median latency saved per job: {saved:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
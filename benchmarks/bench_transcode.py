@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Transcode benchmark - legacy pydub round trip vs. single-pass ffmpeg.
+
+The legacy path reproduces what download_audio used to do: yt-dlp's
+FFmpegExtractAudio writes a WAV, pydub decodes it into memory and exports it
+again. The single-pass path is app.transcode_to_wav().
+
+Each mode runs in its own child process so wall-clock time, CPU time and
+peak RSS (of the Python process and of its ffmpeg children) are measured
+independently.
+
+Usage:
+    python benchmarks/bench_transcode.py                 # 1-hour synthetic input
+    python benchmarks/bench_transcode.py --source in.m4a # your own input
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+FFMPEG_BINARY = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+
+
+def make_source(path, duration):
+    """Generate a compressed stereo test input of the given duration."""
+    subprocess.run([
+        FFMPEG_BINARY, '-nostdin', '-hide_banner', '-loglevel', 'error', '-y',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:sample_rate=44100:duration={duration}',
+        '-ac', '2', '-c:a', 'aac', '-b:a', '160k', path,
+    ], check=True)
+
+
+def run_legacy(source, output):
+    """Two ffmpeg passes plus a full in-memory copy (the old code path)."""
+    from pydub import AudioSegment
+
+    extracted = output + '.extract.wav'
+    subprocess.run([
+        FFMPEG_BINARY, '-nostdin', '-hide_banner', '-loglevel', 'error', '-y',
+        '-i', source, '-vn', '-ar', '48000', '-ac', '2', '-acodec', 'pcm_s16le', extracted,
+    ], check=True)
+    audio = AudioSegment.from_file(extracted)
+    audio.export(output, format="wav",
+                 parameters=["-acodec", "pcm_s16le", "-ar", "48000", "-ac", "2", "-b:a", "320k"])
+    os.remove(extracted)
+
+
+def run_single_pass(source, output):
+    from app import transcode_to_wav
+    transcode_to_wav(source, output)
+
+
+MODES = {
+    'legacy': run_legacy,
+    'single-pass': run_single_pass,
+}
+
+
+def child_main(mode, source, output):
+    """Run one mode and report resource usage as JSON on stdout."""
+    start = time.perf_counter()
+    MODES[mode](source, output)
+    wall = time.perf_counter() - start
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    print(json.dumps({
+        'wall_s': wall,
+        'cpu_s': own.ru_utime + own.ru_stime + kids.ru_utime + kids.ru_stime,
+        'python_peak_rss_mb': own.ru_maxrss * scale / (1024 * 1024),
+        'ffmpeg_peak_rss_mb': kids.ru_maxrss * scale / (1024 * 1024),
+        'output_mb': os.path.getsize(output) / (1024 * 1024),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source', help='input file (default: generate a synthetic one)')
+    parser.add_argument('--duration', type=int, default=3600, help='synthetic input length in seconds')
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--child', nargs=3, metavar=('MODE', 'SOURCE', 'OUTPUT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child_main(*args.child)
+        return
+
+    workdir = tempfile.mkdtemp(prefix='bench_transcode_')
+    try:
+        source = args.source
+        if not source:
+            source = os.path.join(workdir, 'source.m4a')
+            print(f"Generating {args.duration}s synthetic input...")
+            make_source(source, args.duration)
+
+        results = {}
+        for mode in args.modes:
+            output = os.path.join(workdir, f'{mode}.wav')
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', mode, source, output],
+                                  stdout=subprocess.PIPE, text=True, check=True)
+            results[mode] = json.loads(proc.stdout.strip().splitlines()[-1])
+            os.remove(output)
+
+        print(f"{'mode':<12} {'wall s':>8} {'cpu s':>8} {'py RSS MB':>10} {'ffmpeg RSS MB':>14} {'out MB':>8}")
+        for mode, r in results.items():
+            print(f"{mode:<12} {r['wall_s']:>8.2f} {r['cpu_s']:>8.2f} {r['python_peak_rss_mb']:>10.1f} "
+                  f"{r['ffmpeg_peak_rss_mb']:>14.1f} {r['output_mb']:>8.1f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""Tests for the FLAC frame scanner behind the seek index (build_seek_index)."""
+import os
+import random
+import struct
+import tempfile
+import unittest
+
+import app
+
+BLOCKSIZE = 4096
+
+
+def coded_number(n):
+    """FLAC's UTF-8-style coding of a frame number."""
+    if n < 0x80:
+        return bytes([n])
+    for extra in range(1, 7):
+        if n < 1 << (6 - extra + 6 * extra):
+            lead = (0xFF00 >> (extra + 1)) & 0xFF
+            out = [lead | (n >> (6 * extra))]
+            out += [0x80 | ((n >> (6 * k)) & 0x3F) for k in range(extra - 1, -1, -1)]
+            return bytes(out)
+    raise ValueError(n)
+
+
+def frame_header(number, blocksize_code=12, channels=0x1):
+    """A fixed-blocksize frame header (4096 samples, 48 kHz, 16 bit) with its CRC-8."""
+    header = bytes([0xFF, 0xF8, (blocksize_code << 4) | 0xA, (channels << 4) | 0x8]) + coded_number(number)
+    crc = 0
+    for b in header:
+        crc = app.FLAC_CRC8_TABLE[crc ^ b]
+    return header + bytes([crc])
+
+
+def streaminfo(total_samples):
+    body = struct.pack('>HH', BLOCKSIZE, BLOCKSIZE) + b'\0' * 6
+    body += ((48000 << 44) | (1 << 41) | (15 << 36) | total_samples).to_bytes(8, 'big')
+    body += b'\0' * 16
+    return b'fLaC' + bytes([0x80]) + len(body).to_bytes(3, 'big') + body
+
+
+def noise(rng, size):
+    """Random bytes without accidental sync codes; false syncs are planted explicitly."""
+    data = bytearray(rng.randbytes(size))
+    for i in range(len(data)):
+        if data[i] == 0xFF:
+            data[i] = 0xFE
+    return bytes(data)
+
+
+class BuildSeekIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.flac')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def write_stream(self, frames, plant):
+        """Write frames of noise; plant(number) returns false headers hidden in that frame."""
+        rng = random.Random(frames)
+        data = bytearray(streaminfo(frames * BLOCKSIZE))
+        offsets = []
+        for number in range(frames):
+            offsets.append(len(data))
+            data += frame_header(number)
+            payload = bytearray(noise(rng, rng.randrange(6000, 12000)))
+            for fake in plant(number):
+                at = rng.randrange(0, len(payload) - len(fake))
+                payload[at:at + len(fake)] = fake
+            data += payload
+            data += app.flac_crc16(data[offsets[-1]:]).to_bytes(2, 'big')
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        return offsets
+
+    def expected_points(self, offsets, interval):
+        step = interval * app.SAMPLE_RATE
+        points = []
+        for number, offset in enumerate(offsets):
+            sample = number * BLOCKSIZE
+            if not points or sample >= points[-1][0] + step:
+                points.append([sample, offset])
+        return points
+
+    def test_points_match_real_frames(self):
+        offsets = self.write_stream(300, lambda number: [])
+        index = app.build_seek_index(self.path, 1)
+        self.assertEqual(index['header_size'], offsets[0])
+        self.assertEqual(index['points'], self.expected_points(offsets, 1))
+
+    def test_false_syncs_with_valid_crc8_are_ignored(self):
+        # Headers with a valid CRC-8 inside the audio: frames ahead of the
+        # real next one, repeats of earlier frames, and a different block size
+        def plant(number):
+            return [frame_header(number + 7), frame_header(number + 1000),
+                    frame_header(max(0, number - 1)), frame_header(number + 1, blocksize_code=9)]
+        offsets = self.write_stream(300, plant)
+        index = app.build_seek_index(self.path, 1)
+        self.assertEqual(index['points'], self.expected_points(offsets, 1))
+
+    def test_false_sync_posing_as_next_frame_is_never_a_point(self):
+        # A header identical to the real next one, inside every third frame:
+        # only the CRC-16 of the frame before a seek point can tell them apart
+        offsets = self.write_stream(300, lambda number: [frame_header(number + 1)] if number % 3 == 0 else [])
+        index = app.build_seek_index(self.path, 1)
+        real = {number * BLOCKSIZE: offset for number, offset in enumerate(offsets)}
+        self.assertGreater(len(index['points']), 20)
+        for sample, offset in index['points']:
+            self.assertEqual(real[sample], offset)
+        gaps = [b[0] - a[0] for a, b in zip(index['points'], index['points'][1:])]
+        self.assertLessEqual(max(gaps), app.SAMPLE_RATE + 2 * BLOCKSIZE)
+
+    def test_rejects_non_flac(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'RIFF' + b'\0' * 100)
+        with self.assertRaises(ValueError):
+            app.build_seek_index(self.path, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()